@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Micro-benchmark of Precision.apply against the previous implementation
+based on POSIX timestamps.
+
+Run from the repository root:
+
+    python benchmarks/bench_precision.py
+"""
+from datetime import datetime, timedelta, timezone
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from privacydates.precision import Precision  # noqa: E402
+
+
+def legacy_apply(precision: Precision, dt: datetime) -> datetime:
+    """Precision.apply as implemented before the component based rewrite"""
+    if precision.seconds:
+        if not isinstance(dt, datetime):
+            raise TypeError("dt must be datetime (was %s)" % type(dt))
+        if not isinstance(precision.seconds, int):
+            raise TypeError("reduction_divisor must be int")
+        if precision.seconds <= 0:
+            raise ValueError("reduction_divisor must be positive")
+        reduced_unixtime = (
+            (int(dt.replace(tzinfo=timezone.utc).timestamp())
+             // precision.seconds) * precision.seconds
+        )
+        return datetime.utcfromtimestamp(reduced_unixtime)\
+            .replace(tzinfo=dt.tzinfo)
+    dt = dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if precision.months:
+        return dt.replace(
+            month=((dt.month - 1) // precision.months) * precision.months + 1)
+    dt = dt.replace(month=1)
+    return dt.replace(year=(dt.year // precision.years) * precision.years)
+
+
+PRECISIONS = {
+    'seconds': Precision(minutes=15),
+    'months': Precision(months=3),
+    'years': Precision(years=1),
+}
+
+
+def main(number: int = 200000) -> None:
+    dt = datetime(2021, 11, 4, 13, 37, 42, 123456,
+                  tzinfo=timezone(timedelta(hours=1)))
+    print("%-8s %12s %12s %8s" % ("kind", "legacy ns", "apply ns", "speedup"))
+    for kind, precision in PRECISIONS.items():
+        assert legacy_apply(precision, dt) == precision.apply(dt)
+        legacy = min(timeit.repeat(lambda: legacy_apply(precision, dt),
+                                   number=number, repeat=3)) / number
+        current = min(timeit.repeat(lambda: precision.apply(dt),
+                                    number=number, repeat=3)) / number
+        print("%-8s %12.0f %12.0f %7.2fx" % (
+            kind, legacy * 1e9, current * 1e9, legacy / current))
+
+
+if __name__ == '__main__':
+    main()
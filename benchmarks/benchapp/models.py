@@ -0,0 +1,19 @@
+"""Models used by the benchmarks"""
+from django.db import models
+
+from privacydates.fields import OrderingDateField, VanishingDateField
+from privacydates.managers import OrderingDateQuerySet, VanishingDateQuerySet
+from privacydates.mixins import VanishingDateMixIn
+
+
+class OrderedItem(models.Model):
+    ordering = OrderingDateField()
+
+    objects = OrderingDateQuerySet.as_manager()
+
+
+class VanishingItem(models.Model, VanishingDateMixIn):
+    created = VanishingDateField()
+    updated = VanishingDateField()
+
+    objects = VanishingDateQuerySet.as_manager()
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+"""Benchmark suite of the privacydates hot paths.
+
+Runs offline against an in-memory SQLite database, or against PostgreSQL
+configured by the usual PG* environment variables (PGDATABASE, PGHOST,
+PGPORT, PGUSER, PGPASSWORD). A temporary test database is created and
+destroyed like by the test runner.
+
+Run from the repository root:
+
+    python benchmarks/run.py [--database postgresql] [--sizes 10000,100000]
+    python benchmarks/run.py --save-baseline benchmarks/baseline-sqlite.json
+    python benchmarks/run.py --compare benchmarks/baseline-sqlite.json
+
+Each benchmark reports operations per second and database queries per
+operation. With --compare, the exit code is 1 if a benchmark is slower than
+the baseline by more than --tolerance or issues more queries per operation.
+"""
+import argparse
+from datetime import datetime, timedelta, timezone as dt_timezone
+import json
+import os
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, os.pardir))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+# default numbers of due events for update_vanishing
+DEFAULT_SIZES = (10000, 100000, 1000000)
+BATCH_SIZE = 1000
+
+
+def configure(database: str) -> None:
+    if database == 'postgresql':
+        db = {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('PGDATABASE', 'privacydates'),
+            'HOST': os.environ.get('PGHOST', ''),
+            'PORT': os.environ.get('PGPORT', ''),
+            'USER': os.environ.get('PGUSER', ''),
+            'PASSWORD': os.environ.get('PGPASSWORD', ''),
+        }
+    else:
+        db = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        }
+    settings.configure(
+        DATABASES={'default': db},
+        INSTALLED_APPS=[
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'privacydates',
+            'benchapp',
+        ],
+        DEFAULT_AUTO_FIELD='django.db.models.BigAutoField',
+        USE_TZ=True,
+    )
+    django.setup()
+
+
+class Benchmark:
+    """A measured operation, repeated ops times.
+
+    setup prepares the data outside the measurement, run performs the
+    operations and may return their number if it is only known afterwards.
+    """
+
+    def __init__(self, name: str, run: Callable[[], Optional[int]], ops: int,
+                 setup: Optional[Callable[[], None]] = None):
+        self.name = name
+        self.run = run
+        self.ops = ops
+        self.setup = setup
+
+
+class Result:
+    """Measurement of a benchmark"""
+
+    def __init__(self, ops: int, seconds: float, queries: int):
+        self.ops = ops
+        self.seconds = seconds
+        self.queries = queries
+
+    @property
+    def ops_per_sec(self) -> float:
+        return self.ops / self.seconds
+
+    @property
+    def queries_per_op(self) -> float:
+        return self.queries / self.ops
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            'ops': self.ops,
+            'ops_per_sec': round(self.ops_per_sec, 1),
+            'queries_per_op': round(self.queries_per_op, 4),
+        }
+
+
+def measure(benchmark: Benchmark) -> Result:
+    """Time the run of benchmark and count its queries."""
+    from django.db import connection
+
+    queries = 0
+
+    def count_query(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    if benchmark.setup is not None:
+        benchmark.setup()
+    with connection.execute_wrapper(count_query):
+        start = time.perf_counter()
+        ops = benchmark.run()
+        seconds = time.perf_counter() - start
+    return Result(benchmark.ops if ops is None else ops, seconds, queries)
+
+
+def reset() -> None:
+    """Empty all tables and caches between benchmarks."""
+    from django.core.management import call_command
+    from privacydates.models import VanishingPolicy
+    from privacydates.order import release_ordering_blocks
+    from privacydates.vanish import clear_policy_registry
+
+    call_command('flush', interactive=False, verbosity=0)
+    VanishingPolicy.objects.clear_cached()
+    clear_policy_registry()
+    release_ordering_blocks()
+
+
+def policy_steps():
+    from privacydates.precision import Precision
+    return [
+        Precision(minutes=1),
+        Precision(hours=1).after(minutes=30),
+        Precision(days=1).after(days=2),
+    ]
+
+
+def precision_benchmarks() -> List[Benchmark]:
+    from privacydates.precision import Precision
+
+    dt = datetime(2021, 11, 4, 13, 37, 42, 123456,
+                  tzinfo=dt_timezone(timedelta(hours=1)))
+    number = 100000
+    benchmarks = []
+    for kind, precision in (('seconds', Precision(minutes=15)),
+                            ('months', Precision(months=3)),
+                            ('years', Precision(years=1))):
+        def run(apply=precision.apply):
+            for _ in range(number):
+                apply(dt)
+        benchmarks.append(Benchmark('precision_apply_' + kind, run, number))
+    return benchmarks
+
+
+def factory_benchmarks() -> List[Benchmark]:
+    from django.utils import timezone
+    from privacydates.vanish import VanishingFactory
+
+    number = 1000
+    benchmarks = []
+    for name, context in (('factory_create', None),
+                          ('factory_create_context', 'bench')):
+        def run(context=context):
+            factory = VanishingFactory(policy_steps())
+            now = timezone.now()
+            for _ in range(number):
+                factory.create(now, context=context)
+        benchmarks.append(Benchmark(name, run, number))
+    return benchmarks
+
+
+def ordering_benchmarks() -> List[Benchmark]:
+    from benchapp.models import OrderedItem
+
+    number = 1000
+
+    def run():
+        for i in range(number):
+            OrderedItem(ordering="user%d" % (i % 10)).save()
+    return [Benchmark('orderingdate_save', run, number)]
+
+
+def vanishing_benchmarks(sizes) -> List[Benchmark]:
+    from django.utils import timezone
+    from privacydates.vanish import VanishingFactory, update_vanishing
+
+    def setup(size):
+        factory = VanishingFactory(policy_steps())
+        past = timezone.now() - timedelta(hours=1)
+        # each date has one due event
+        for start in range(0, size, 10 * BATCH_SIZE):
+            factory.bulk_create([past] * min(10 * BATCH_SIZE, size - start),
+                                batch_size=BATCH_SIZE)
+
+    def run():
+        return update_vanishing(batch_size=BATCH_SIZE).events
+
+    return [
+        Benchmark('update_vanishing_%d' % size, run, size,
+                  setup=lambda size=size: setup(size))
+        for size in sizes
+    ]
+
+
+def deletion_benchmarks() -> List[Benchmark]:
+    from django.utils import timezone
+    from benchapp.models import VanishingItem
+    from privacydates.vanish import VanishingFactory
+
+    number = 1000
+
+    def setup():
+        dates = VanishingFactory(policy_steps()).bulk_create(
+            [timezone.now()] * (2 * number))
+        VanishingItem.objects.bulk_create([
+            VanishingItem(created=dates[2 * i], updated=dates[2 * i + 1])
+            for i in range(number)
+        ])
+
+    def run_single():
+        for item in VanishingItem.objects.all().iterator():
+            item.delete()
+
+    def run_queryset():
+        VanishingItem.objects.all().delete()
+
+    return [
+        Benchmark('mixin_delete_single', run_single, number, setup=setup),
+        Benchmark('mixin_delete_queryset', run_queryset, number, setup=setup),
+    ]
+
+
+def run_benchmarks(sizes, only: Optional[str] = None) -> Dict[str, Result]:
+    benchmarks = (precision_benchmarks() + factory_benchmarks()
+                  + ordering_benchmarks() + vanishing_benchmarks(sizes)
+                  + deletion_benchmarks())
+    results = {}
+    for benchmark in benchmarks:
+        if only and only not in benchmark.name:
+            continue
+        reset()
+        result = measure(benchmark)
+        results[benchmark.name] = result
+        print("%-28s %14.1f ops/s %10.3f queries/op" % (
+            benchmark.name, result.ops_per_sec, result.queries_per_op),
+            flush=True)
+    return results
+
+
+def compare(results: Dict[str, Result], baseline: Dict[str, dict],
+            tolerance: float) -> bool:
+    """Print the changes against baseline, return whether any benchmark
+    regressed."""
+    regressed = False
+    print("\n%-28s %10s %12s" % ("compared to baseline", "ops/s", "queries/op"))
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print("%-28s %10s" % (name, "new"))
+            continue
+        speed = result.ops_per_sec / base['ops_per_sec']
+        queries = result.queries_per_op - base['queries_per_op']
+        slower = speed < 1 - tolerance
+        more_queries = queries > 1e-3
+        regressed |= slower or more_queries
+        print("%-28s %9.2fx %+12.3f%s" % (
+            name, speed, queries,
+            "  REGRESSION" if slower or more_queries else ""))
+    return regressed
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database', choices=('sqlite', 'postgresql'),
+                        default='sqlite')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='Comma separated numbers of due events for '
+                             'update_vanishing (default: %(default)s)')
+    parser.add_argument('--only', metavar='NAME',
+                        help='Only run benchmarks whose name contains NAME')
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help='Store the results as baseline JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Compare the results to a baseline JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown against the baseline '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+
+    configure(args.database)
+    from django.db import connection
+
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        print("database: %s" % connection.vendor)
+        results = run_benchmarks(sizes, args.only)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({
+                'database': args.database,
+                'results': {name: result.as_dict()
+                            for name, result in results.items()},
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('database') != args.database:
+            print("warning: baseline was measured on %s"
+                  % baseline.get('database'))
+        if compare(results, baseline['results'], args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,21 @@
 from django.contrib import admin
-from .models import VanishingEvent, VanishingPolicy, VanishingDateTime,\
+from .models import VanishingPolicy, VanishingDateTime,\
     OrderingContext, VanishingOrderingContext
 
 # Register your models here.
-admin.site.register(VanishingDateTime)
-admin.site.register(VanishingEvent)
-admin.site.register(VanishingPolicy)
 admin.site.register(OrderingContext)
 admin.site.register(VanishingOrderingContext)
+
+
+@admin.register(VanishingPolicy)
+class VanishingPolicyAdmin(admin.ModelAdmin):
+    # saved policies are immutable, see VanishingPolicy.save
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(VanishingDateTime)
+class VanishingDateTimeAdmin(admin.ModelAdmin):
+    # the model has no default ordering, sort by the indexed date
+    ordering = ('dt',)
+    list_display = ('dt', 'next_event_date', 'next_iteration')
@@ -7,11 +7,22 @@ class PrivacydatesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
 
     def ready(self):
+        from .fields import VanishingDateField
         from .mixins import VanishingDateMixIn
-        from .signals import delete_datetime_of_deleted_parent
+        from .signals import (
+            delete_datetime_of_deleted_parent,
+            vanishing_date_attnames,
+        )
 
         # Register post_delete-Signal for all Subclasses of VanishingDateMixin
         for sub_class in VanishingDateMixIn.__subclasses__():
+            attnames = tuple(
+                field.attname for field in sub_class._meta.concrete_fields
+                if isinstance(field, VanishingDateField)
+            )
+            if not attnames:
+                continue
+            vanishing_date_attnames[sub_class] = attnames
             post_delete.connect(delete_datetime_of_deleted_parent,
                                 sender=sub_class,
                                 dispatch_uid=str(sub_class))
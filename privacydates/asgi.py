@@ -0,0 +1,130 @@
+"""Execution of vanishing events inside an ASGI process"""
+import asyncio
+import logging
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.db import DatabaseError, connection
+
+from .models import VanishingDateTime
+from .vanish import aupdate_vanishing, seconds_until_next_run
+
+
+__all__ = [
+    'VanishingLifespanMiddleware', 'VanishingScheduler',
+]
+
+logger = logging.getLogger(__name__)
+
+
+def _close_unusable_connection():
+    """Drop broken connections instead of failing on every run."""
+    if connection.connection is not None and not connection.is_usable():
+        connection.close()
+
+
+class VanishingScheduler:
+    """Background task executing due vanishing events in the event loop of
+    an ASGI process, like the vanishdates command in daemon mode.
+    """
+
+    def __init__(self, batch_size: int = 1000, max_interval: float = 60.0):
+        """
+        Parameters
+        ----------
+        batch_size : int
+            Number of events executed per transaction
+        max_interval : float
+            Maximum seconds to sleep between runs, so that events created in
+            the meantime are picked up
+        """
+        if max_interval <= 0:
+            raise ValueError("max_interval must be positive")
+        self.batch_size = batch_size
+        self.max_interval = max_interval
+        self._stop: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Start the scheduler as task of the running event loop."""
+        if self._task is not None:
+            raise RuntimeError("Scheduler is already running")
+        self._stop = asyncio.Event()
+        self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self) -> None:
+        """Stop the scheduler and wait for the current run to finish."""
+        if self._task is None:
+            return
+        self._stop.set()
+        await self._task
+        self._task = None
+
+    async def run(self) -> None:
+        """Execute due events and sleep until the next event is due (at most
+        max_interval seconds, see seconds_until_next_run), until stopped.
+
+        Failed runs are logged and retried after max_interval, so that an
+        error never stops the vanishing for the lifetime of the server.
+        """
+        while not self._stop.is_set():
+            executed = 0
+            try:
+                await sync_to_async(_close_unusable_connection,
+                                    thread_sensitive=True)()
+                stats = await aupdate_vanishing(batch_size=self.batch_size)
+                executed = stats.events
+                next_date = await sync_to_async(
+                    VanishingDateTime.objects.next_event_date,
+                    thread_sensitive=True)()
+            except DatabaseError:
+                logger.exception("Vanishing failed")
+                await sync_to_async(connection.close,
+                                    thread_sensitive=True)()
+                next_date = None
+            except Exception:
+                logger.exception("Vanishing failed")
+                next_date = None
+            timeout = seconds_until_next_run(next_date, executed,
+                                             self.max_interval)
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class VanishingLifespanMiddleware:
+    """ASGI middleware running a VanishingScheduler for the lifetime of the
+    server, using the ASGI lifespan protocol. All other connections are
+    passed to the wrapped application.
+
+    Django's ASGI handler does not support lifespan events itself, so wrap
+    it in asgi.py:
+
+        application = VanishingLifespanMiddleware(get_asgi_application())
+    """
+
+    def __init__(self, app, **scheduler_options):
+        """
+        Parameters
+        ----------
+        app
+            ASGI application to wrap
+        scheduler_options
+            Options passed to VanishingScheduler
+        """
+        self.app = app
+        self.scheduler = VanishingScheduler(**scheduler_options)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'lifespan':
+            return await self.app(scope, receive, send)
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.scheduler.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.scheduler.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
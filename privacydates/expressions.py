@@ -0,0 +1,80 @@
+"""Database expressions for reducing the precision of dates"""
+from django.conf import settings
+from django.db import NotSupportedError, models
+
+from .precision import Precision
+
+
+class ReducePrecision(models.Func):
+    """Expression applying a Precision to a datetime expression inside the
+    database, with the same results as Precision.apply on the stored
+    (in case of USE_TZ, UTC) values.
+
+    Supported on SQLite and PostgreSQL.
+    """
+
+    def __init__(self, expression, precision: Precision, **extra):
+        super().__init__(expression, output_field=models.DateTimeField(),
+                         **extra)
+        self.precision = precision
+
+    def as_sql(self, compiler, connection, **extra_context):
+        raise NotSupportedError("ReducePrecision is not supported on %s"
+                                % connection.vendor)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.source_expressions[0])
+        precision = self.precision
+        if precision.seconds:
+            # Epoch seconds of the stored wall-clock time, rounded down to
+            # multiples of the precision. Like int() of a POSIX timestamp,
+            # fractions of dates before 1970 are truncated towards zero.
+            # Modulo in SQLite keeps the sign of the dividend, so fix it too.
+            seconds = (
+                "(CAST(strftime('%%s', {x}) AS INTEGER)"
+                " + (CAST(strftime('%%s', {x}) AS INTEGER) < 0"
+                " AND CAST(substr({x}, 21) AS INTEGER) > 0))"
+            ).format(x=sql)
+            remainder = "((({s} %% {d}) + {d}) %% {d})".format(
+                s=seconds, d=precision.seconds)
+            template = "datetime({s} - {r}, 'unixepoch')".format(
+                s=seconds, r=remainder)
+            return template, params * 6
+        if precision.months:
+            template = (
+                "strftime('%%Y-', {x}) || printf('%%02d-01 00:00:00',"
+                " ((CAST(strftime('%%m', {x}) AS INTEGER) - 1) / {k}) * {k} + 1)"
+            ).format(x=sql, k=precision.months)
+            return template, params * 2
+        if precision.years:
+            template = (
+                "printf('%%04d-01-01 00:00:00',"
+                " (CAST(strftime('%%Y', {x}) AS INTEGER) / {k}) * {k})"
+            ).format(x=sql, k=precision.years)
+            return template, params
+        raise RuntimeError("Unexpected precision")
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.source_expressions[0])
+        precision = self.precision
+        if precision.seconds:
+            # truncate fractions towards zero like int() of a POSIX timestamp
+            template = (
+                "to_timestamp(floor(trunc(extract(epoch from {x})) / {d}) * {d})"
+            ).format(x=sql, d=precision.seconds)
+            if not settings.USE_TZ:
+                template = "({} AT TIME ZONE 'UTC')".format(template)
+            return template, params
+        if precision.months:
+            template = (
+                "(date_trunc('year', {x}) + make_interval(months =>"
+                " ((extract(month from {x})::integer - 1) / {k}) * {k}))"
+            ).format(x=sql, k=precision.months)
+            return template, params * 2
+        if precision.years:
+            template = (
+                "(date_trunc('year', {x}) - make_interval(years =>"
+                " extract(year from {x})::integer %% {k}))"
+            ).format(x=sql, k=precision.years)
+            return template, params * 2
+        raise RuntimeError("Unexpected precision")
@@ -3,11 +3,18 @@ Django model data fields for storing datetimes
 in a more privacy preserving format
 """
 
+from typing import Dict, Iterable, List, Optional
+import weakref
+
 from django.db import models
+from django.db.models import prefetch_related_objects
+from django.db.models.fields.related_descriptors import (
+    ForwardManyToOneDescriptor,
+)
 from django.utils.translation import gettext_lazy as _
 
 from .models import OrderingContext, VanishingDateTime
-from .order import hash_context_key
+from .order import OrderingBlockAllocator, hash_context_key
 from .precision import Precision
 
 
@@ -51,15 +58,33 @@ class OrderingDateField(models.IntegerField):
     """
     description = _("Ordering Date for sequence or revision counter")
 
-    def __init__(self, *args, similarity_distance=0, hashed=False, **kwargs):
+    def __init__(self, *args, similarity_distance=0, hashed=False,
+                 block_size=None, **kwargs):
+        """IntegerField assigning ordering numbers of a context.
+
+        With a block_size, each process reserves blocks of that many numbers
+        at once and hands them out from memory. Numbers then stay strictly
+        increasing within a process, but may leave gaps and interleave between
+        processes. Blocks can only be used without similarity_distance and
+        can be given back with order.release_ordering_blocks().
+        """
         self.similarity_distance = similarity_distance
         self.hashed = hashed
+        self.block_size = block_size
+        self._allocator = None
+        if block_size is not None:
+            if similarity_distance:
+                raise ValueError("block_size can not be combined with "
+                                 "similarity_distance")
+            self._allocator = OrderingBlockAllocator(block_size)
         super().__init__(*args, **kwargs)
 
     def deconstruct(self):
         name, path, args, kwargs = super().deconstruct()
         kwargs['similarity_distance'] = self.similarity_distance
         kwargs['hashed'] = self.hashed
+        if self.block_size is not None:
+            kwargs['block_size'] = self.block_size
         return name, path, args, kwargs
 
 
@@ -69,21 +94,87 @@ class OrderingDateField(models.IntegerField):
         instead.
         """
         field_input = getattr(model_instance, self.attname)
-        if field_input is None:
+        key = self._context_key(field_input)
+        if key is None:
             return field_input
+        if self._allocator is not None:
+            return self._allocator.next(key)
+        return OrderingContext.objects.next_count(key, self.similarity_distance)
+
+    def assign_many(self, model_instances: Iterable[models.Model]) -> None:
+        """Replace context keys assigned to the field of the given instances
+        by ordering numbers. The numbers of each context are reserved with a
+        single statement and assigned in the given order.
+        """
+        groups: Dict[str, List[models.Model]] = {}
+        for instance in model_instances:
+            key = self._context_key(getattr(instance, self.attname))
+            if key is not None:
+                groups.setdefault(key, []).append(instance)
+        for key, group in groups.items():
+            if self._allocator is not None:
+                counts = [self._allocator.next(key) for _ in group]
+            else:
+                counts = OrderingContext.objects.next_counts(
+                    key, len(group), self.similarity_distance)
+            for instance, count in zip(group, counts):
+                setattr(instance, self.attname, count)
+
+    def _context_key(self, field_input) -> Optional[str]:
+        """Return the (hashed) context key for a field value, or None if the
+        value is no context key"""
+        if field_input is None:
+            return None
         if isinstance(field_input, int):
-            return field_input
+            return None
         if not isinstance(field_input, str):
             raise TypeError('Ordering key must be a string, but is '
                             + str(type(field_input)))
-        key = field_input
         if self.hashed:
-            key = hash_context_key(key)
-        context, _ = OrderingContext.objects.get_or_create(
-            context_key=key,
-            similarity_distance=self.similarity_distance,
-        )
-        return context.next()
+            return hash_context_key(field_input)
+        return field_input
+
+
+class PeerGroup:
+    """Objects fetched together, shared by these objects.
+
+    The objects are referenced weakly, so that no object keeps the others
+    alive, and the group is pickled (or copied) empty, so that pickles of an
+    object do not contain the others.
+    """
+    __slots__ = ('_refs',)
+
+    def __init__(self, objs: Iterable = ()):
+        self._refs = [weakref.ref(obj) for obj in objs]
+
+    def __reduce__(self):
+        return (PeerGroup, ())
+
+    def __iter__(self):
+        for ref in self._refs:
+            obj = ref()
+            if obj is not None:
+                yield obj
+
+
+class VanishingDateDescriptor(ForwardManyToOneDescriptor):
+    """Accessor of VanishingDateFields.
+
+    Objects fetched by a VanishingDateQuerySet know the other objects fetched
+    with them (as PeerGroup). On first access, the dates of all these objects
+    which are still alive are loaded with a single query instead of one query
+    per object.
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is not None and not self.is_cached(instance):
+            peers = getattr(instance, '_vanishing_peers', None)
+            if peers is not None:
+                prefetch_related_objects(
+                    [peer for peer in peers if not self.is_cached(peer)],
+                    self.field.name,
+                )
+        return super().__get__(instance, cls)
 
 
 class VanishingDateField(models.ForeignKey):
@@ -91,6 +182,7 @@ class VanishingDateField(models.ForeignKey):
      VanishingDateTime
     """
     description = _("Field handles relationship to VanishingDateTime")
+    forward_related_accessor_class = VanishingDateDescriptor
 
     def __init__(self, *args, **kwargs):
         kwargs.setdefault('on_delete', models.CASCADE)
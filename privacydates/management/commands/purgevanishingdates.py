@@ -0,0 +1,83 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ...models import VanishingDateTime
+from ...signals import unreferenced
+from .vanishdates import parse_duration
+
+
+class Command(BaseCommand):
+    """Management command to delete VanishingDateTimes which are not
+    referenced by any VanishingDateField, e.g. left behind by raw deletes or
+    models without VanishingDateMixIn.
+
+    Dates created with VanishingFactory are unreferenced until the object
+    referencing them is saved, so only dates older than a grace period are
+    collected.
+    """
+    help = 'Deletes vanishing dates not referenced by any VanishingDateField'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of dates read and deleted per query',
+        )
+        parser.add_argument(
+            '--older-than', default='1d',
+            help='Only delete dates created before this grace period, '
+                 'e.g. 30m, 24h or 7d (default: 1d)',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only count orphaned dates, delete nothing',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size <= 0:
+            raise CommandError("--batch-size must be positive")
+        count = purge_orphaned_dates(batch_size,
+                                     parse_duration(options['older_than']),
+                                     options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write("%d orphaned vanishing dates found" % count)
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                "%d orphaned vanishing dates deleted" % count))
+
+
+def purge_orphaned_dates(batch_size: int,
+                         older_than: timedelta = timedelta(days=1),
+                         dry_run=False) -> int:
+    """Delete unreferenced VanishingDateTimes created more than older_than
+    ago.
+
+    Orphans are selected in chunks ordered by primary key with one anti-join
+    per VanishingDateField. Each chunk is deleted with the anti-joins
+    applied again, so dates referenced since the selection are kept.
+
+    Returns
+    -------
+    int
+        Number of orphaned (and deleted, unless dry_run) dates
+    """
+    orphans = unreferenced(VanishingDateTime.objects.filter(
+        created__lt=timezone.now() - older_than))
+    pks = orphans.order_by('pk').values_list('pk', flat=True)
+    count = 0
+    last_pk = None
+    while True:
+        chunk = pks
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:batch_size])
+        if not chunk:
+            return count
+        last_pk = chunk[-1]
+        if dry_run:
+            count += len(chunk)
+        else:
+            # Dates have no dependent rows, so they are not fetched
+            count += orphans.filter(pk__in=chunk)._raw_delete(orphans.db)
@@ -0,0 +1,118 @@
+from functools import reduce
+from operator import or_
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
+from django.db.models import Case, Q, Value, When
+from django.utils import timezone
+
+from ...fields import RoughDateField
+from ...precision import Precision
+
+
+class Command(BaseCommand):
+    """Management command to re-apply the current precision of all
+    RoughDateFields to existing rows, e.g. after the precision of a field
+    was reduced.
+    """
+    help = 'Reduces stored RoughDateField values to their current precision'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'models', nargs='*', metavar='app_label.ModelName',
+            help='Only process the given models (default: all models)',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of rows read and updated per query',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size <= 0:
+            raise CommandError("--batch-size must be positive")
+        if options['models']:
+            try:
+                models = [apps.get_model(label) for label in options['models']]
+            except (LookupError, ValueError) as e:
+                raise CommandError(str(e))
+        else:
+            models = apps.get_models()
+        for model in models:
+            if model._meta.proxy or not model._meta.managed:
+                continue
+            for field in model._meta.concrete_fields:
+                if isinstance(field, RoughDateField):
+                    updated = roughen_field(model, field, batch_size)
+                    self.stdout.write("%s.%s: %d rows updated" % (
+                        model._meta.label, field.name, updated))
+        self.stdout.write(self.style.SUCCESS('Rough dates updated'))
+
+
+def at_precision(precision: Precision, value) -> bool:
+    """Whether value is already reduced to precision.
+
+    RoughDateField reduces the wall-clock time of the assigned value, so
+    values assigned in the current time zone (e.g. from localtime() or
+    forms) are reduced in that zone, not in UTC. Values assigned in any
+    other time zone can not be recognized and are reduced again in UTC.
+    """
+    if precision.apply(value) == value:
+        return True
+    if not timezone.is_aware(value):
+        return False
+    local = timezone.localtime(value)
+    return precision.apply(local) == local
+
+
+def roughen_field(model, field: RoughDateField, batch_size: int) -> int:
+    """Re-apply the precision of field to all rows of model.
+
+    Rows are read in chunks ordered by primary key, and only rows not at the
+    precision yet (see at_precision) are updated, with one query per chunk. The update never writes a
+    value computed from the read one, so rows saved in the meantime are not
+    reverted: on SQLite and PostgreSQL the stored value is reduced inside the
+    database, elsewhere only rows still holding the read value are updated.
+
+    Returns
+    -------
+    int
+        Number of updated rows
+    """
+    pk_name = model._meta.pk.attname
+    manager = model._base_manager.db_manager(router.db_for_write(model))
+    in_database = connections[manager.db].vendor in ('sqlite', 'postgresql')
+    rows = manager.filter(**{field.attname + '__isnull': False})\
+        .order_by(pk_name).values_list(pk_name, field.attname)
+    updated = 0
+    last_pk = None
+    while True:
+        chunk = rows
+        if last_pk is not None:
+            chunk = chunk.filter(**{pk_name + '__gt': last_pk})
+        chunk = list(chunk[:batch_size])
+        if not chunk:
+            return updated
+        last_pk = chunk[-1][0]
+        changed = []
+        for pk, value in chunk:
+            if not at_precision(field.precision, value):
+                changed.append((pk, value, field.precision.apply(value)))
+        if not changed:
+            continue
+        if in_database:
+            updated += manager.filter(
+                **{pk_name + '__in': [pk for pk, _, _ in changed]}
+            ).update(**{
+                field.attname: field.precision.as_expression(field.attname)
+            })
+        else:
+            updated += manager.filter(reduce(or_, (
+                Q(**{pk_name: pk, field.attname: value})
+                for pk, value, _ in changed
+            ))).update(**{field.attname: Case(
+                *[When(**{pk_name: pk}, then=Value(rough))
+                  for pk, _, rough in changed],
+                output_field=field,
+            )})
@@ -1,6 +1,45 @@
-from django.core.management.base import BaseCommand
+from collections import Counter
+from datetime import timedelta
+import multiprocessing
+import os
+import re
+import signal
+import tempfile
+import threading
+import traceback
 
-from ...vanish import update_vanishing
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, connections
+from django.utils import timezone
+
+from ...models import VanishingDateTime
+from ...stats import VanishingRunStats
+from ...vanish import seconds_until_next_run, update_vanishing
+
+# batch size of worker processes if --batch-size is not given
+DEFAULT_WORKER_BATCH_SIZE = 1000
+
+# width of the longest bar of the --plan histogram
+PLAN_BAR_WIDTH = 40
+
+DURATION_UNITS = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}
+
+
+def parse_duration(value):
+    """Parse durations like 90s, 30m, 24h or 7d."""
+    match = re.fullmatch(r'(\d+)([smhd])', value.strip())
+    if match is None:
+        raise CommandError(
+            "Invalid duration %r, use e.g. 30m, 24h or 7d" % value)
+    return timedelta(**{DURATION_UNITS[match.group(2)]: int(match.group(1))})
+
+
+def run_worker(batch_size):
+    """Entry point of a worker process started by --workers."""
+    try:
+        return update_vanishing(batch_size=batch_size)
+    finally:
+        connections.close_all()
 
 
 class Command(BaseCommand):
@@ -9,6 +48,192 @@ class Command(BaseCommand):
     """
     help = 'Runs a task that executes all scheduled vanishing_dates'
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # set to stop the daemon
+        self.stop = threading.Event()
+        # accumulated statistics of all runs
+        self.stats = VanishingRunStats()
+        self.stats_file = None
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Execute due events set-based in chunks of this size',
+        )
+        parser.add_argument(
+            '--daemon', action='store_true',
+            help='Keep running and execute events when they become due',
+        )
+        parser.add_argument(
+            '--max-interval', type=float, default=60.0,
+            help='Maximum seconds the daemon sleeps between runs '
+                 '(default: 60)',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of local worker processes executing events '
+                 'concurrently (default: 1)',
+        )
+        parser.add_argument(
+            '--plan', action='store_true',
+            help='Only show the overdue and scheduled events without '
+                 'executing them',
+        )
+        parser.add_argument(
+            '--horizon', default='24h',
+            help='Time span shown by --plan, e.g. 30m, 24h or 7d '
+                 '(default: 24h)',
+        )
+        parser.add_argument(
+            '--bucket', default='hour',
+            choices=('minute', 'hour', 'day', 'week', 'month'),
+            help='Interval of the --plan histogram (default: hour)',
+        )
+        parser.add_argument(
+            '--stats', metavar='FILE', default=None,
+            help='Write run statistics and the backlog in the Prometheus '
+                 'text format to FILE ("-" for stdout), e.g. for the '
+                 'textfile collector of the node exporter',
+        )
+
     def handle(self, *args, **options):
-        update_vanishing()
-        self.stdout.write(self.style.SUCCESS('Vanishing executed'))
+        if options['plan']:
+            if options['daemon'] or options['workers'] > 1:
+                raise CommandError(
+                    "--plan can't be used with --daemon or --workers")
+            self.show_plan(parse_duration(options['horizon']),
+                           options['bucket'])
+            return
+        self.stats_file = options['stats']
+        if options['workers'] <= 0:
+            raise CommandError("--workers must be positive")
+        if options['workers'] > 1:
+            if options['daemon']:
+                raise CommandError("--workers can't be used with --daemon")
+            self.run_workers(options['workers'], options['batch_size'])
+            self.finish_run()
+            return
+        if not options['daemon']:
+            self.stats.merge(update_vanishing(batch_size=options['batch_size']))
+            self.finish_run()
+            return
+        if options['max_interval'] <= 0:
+            raise CommandError("--max-interval must be positive")
+        previous_handlers = {
+            signum: signal.signal(signum, self._handle_signal)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            self.run_daemon(options['batch_size'], options['max_interval'])
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+        self.stdout.write(self.style.SUCCESS('Vanishing daemon stopped'))
+
+    def run_workers(self, workers, batch_size):
+        """Execute due events in the given number of forked processes,
+        each claiming batches of events until none is left."""
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise CommandError("--workers requires the fork start method")
+        if batch_size is None:
+            batch_size = DEFAULT_WORKER_BATCH_SIZE
+        # children must not share the connections of the parent
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            for stats in pool.map(run_worker, [batch_size] * workers):
+                self.stats.merge(stats)
+
+    def show_plan(self, horizon, bucket):
+        """Print the overdue events and a histogram of the events scheduled
+        within horizon, without modifying anything."""
+        now = timezone.now()
+        backlog = VanishingDateTime.objects.backlog(now)
+        if backlog.pending:
+            oldest = timedelta(seconds=int(backlog.oldest_age.total_seconds()))
+            self.stdout.write("Overdue events: %d (oldest due since %s)" % (
+                backlog.pending, oldest))
+        else:
+            self.stdout.write("Overdue events: 0")
+        end = now + horizon
+        rows = list(VanishingDateTime.objects.schedule(now, end, bucket))
+        if timezone.is_aware(end):
+            # buckets are truncated in the current time zone
+            end = timezone.localtime(end)
+        self.stdout.write("Scheduled events until %s by %s:" % (
+            end.strftime('%Y-%m-%d %H:%M'), bucket))
+        per_bucket = Counter()
+        per_step = Counter()
+        for row in rows:
+            per_bucket[row['bucket']] += row['count']
+            per_step[row['policy'], row['iteration']] += row['count']
+        largest = max(per_bucket.values(), default=0)
+        for start, count in sorted(per_bucket.items()):
+            bar = '#' * max(1, round(count * PLAN_BAR_WIDTH / largest))
+            self.stdout.write("  %s %8d %s" % (
+                start.strftime('%Y-%m-%d %H:%M'), count, bar))
+        self.stdout.write("Scheduled events by policy and step:")
+        for (policy, iteration), count in sorted(per_step.items()):
+            self.stdout.write("  policy %d step %d: %d" % (
+                policy, iteration, count))
+        self.stdout.write("Total scheduled: %d" % sum(per_bucket.values()))
+
+    def finish_run(self):
+        """Report the statistics of the runs so far."""
+        if self.stats_file is not None:
+            self.write_stats(self.stats.to_prometheus(
+                VanishingDateTime.objects.backlog()))
+        if self.stats_file != '-':
+            self.stdout.write(self.style.SUCCESS(
+                'Vanishing executed: %d events in %.2f seconds' % (
+                    self.stats.events, self.stats.seconds)))
+
+    def write_stats(self, text):
+        """Write text to the stats file, atomically replacing it so that
+        readers never see partial content."""
+        if self.stats_file == '-':
+            self.stdout.write(text, ending='')
+            return
+        directory = os.path.dirname(os.path.abspath(self.stats_file))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.stats_file)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _handle_signal(self, signum, frame):
+        self.stop.set()
+
+    def run_daemon(self, batch_size, max_interval):
+        """Execute due events and sleep until the next event is due (at most
+        max_interval seconds, see seconds_until_next_run), until stop is
+        set."""
+        while not self.stop.is_set():
+            executed = 0
+            try:
+                # drop broken connections instead of failing on every run
+                if connection.connection is not None \
+                        and not connection.is_usable():
+                    connection.close()
+                run_stats = update_vanishing(batch_size=batch_size)
+                executed = run_stats.events
+                self.stats.merge(run_stats)
+                if self.stats_file is not None:
+                    self.write_stats(self.stats.to_prometheus(
+                        VanishingDateTime.objects.backlog()))
+                next_date = VanishingDateTime.objects.next_event_date()
+            except DatabaseError as e:
+                self.stderr.write("Vanishing failed: %s" % e)
+                connection.close()
+                next_date = None
+            except Exception:
+                # e.g. a due date of a deleted policy, retried later
+                self.stderr.write("Vanishing failed:\n%s"
+                                  % traceback.format_exc())
+                next_date = None
+            self.stop.wait(
+                seconds_until_next_run(next_date, executed, max_interval))
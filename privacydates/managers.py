@@ -0,0 +1,56 @@
+"""QuerySets for models using privacydates fields"""
+from django.db import models
+from django.db.models.query import ModelIterable
+
+from .fields import OrderingDateField, PeerGroup, VanishingDateField
+from .signals import deferred_vanishing_deletion
+
+
+class OrderingDateQuerySet(models.QuerySet):
+    """QuerySet assigning the numbers of OrderingDateFields in bulk.
+
+    With bulk_create, each ordering context only costs one counter update
+    instead of one per object.
+    """
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for field in self.model._meta.concrete_fields:
+            if isinstance(field, OrderingDateField):
+                field.assign_many(objs)
+        return super().bulk_create(objs, *args, **kwargs)
+
+
+class VanishingDateQuerySet(models.QuerySet):
+    """QuerySet for models with VanishingDateFields.
+
+    The dates of fetched objects are loaded for all objects of the result
+    together, when the first object accesses them.
+    With delete, the dates of all deleted objects (including cascades to
+    other VanishingDateMixIn models) are removed with chunked DELETEs instead
+    of queries per object.
+    """
+
+    def with_vanishing_dates(self):
+        """Fetch the dates of all VanishingDateFields in the same query."""
+        return self.select_related(*(
+            field.name for field in self.model._meta.concrete_fields
+            if isinstance(field, VanishingDateField)
+        ))
+
+    def _fetch_all(self):
+        fetched = self._result_cache is None
+        super()._fetch_all()
+        if fetched and self._iterable_class is ModelIterable \
+                and len(self._result_cache) > 1:
+            # read by VanishingDateDescriptor
+            peers = PeerGroup(self._result_cache)
+            for obj in self._result_cache:
+                obj._vanishing_peers = peers
+
+    def delete(self):
+        with deferred_vanishing_deletion(self.db):
+            return super().delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
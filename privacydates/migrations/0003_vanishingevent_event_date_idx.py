@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('privacydates', '0002_auto_20211026_1114'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='vanishingevent',
+            index=models.Index(fields=['event_date'], name='privacydates_event_date_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('privacydates', '0003_vanishingevent_event_date_idx'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='vanishingdatetime',
+            options={},
+        ),
+        migrations.AddIndex(
+            model_name='vanishingdatetime',
+            index=models.Index(fields=['dt'], name='privacydates_dt_idx'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+from django.db import migrations, models
+
+
+def fold_events(apps, schema_editor):
+    """Move the earliest pending event of each date into its columns"""
+    VanishingDateTime = apps.get_model('privacydates', 'VanishingDateTime')
+    VanishingEvent = apps.get_model('privacydates', 'VanishingEvent')
+    db = schema_editor.connection.alias
+    earliest = VanishingEvent.objects.using(db).filter(
+        vanishing_datetime=models.OuterRef('pk'),
+    ).order_by('event_date', 'iteration')
+    VanishingDateTime.objects.using(db).filter(
+        models.Exists(earliest),
+    ).update(
+        next_event_date=models.Subquery(earliest.values('event_date')[:1]),
+        next_iteration=models.Subquery(earliest.values('iteration')[:1]),
+    )
+
+
+def unfold_events(apps, schema_editor):
+    """Recreate the pending events from the columns"""
+    VanishingDateTime = apps.get_model('privacydates', 'VanishingDateTime')
+    VanishingEvent = apps.get_model('privacydates', 'VanishingEvent')
+    db = schema_editor.connection.alias
+    scheduled = VanishingDateTime.objects.using(db)\
+        .filter(next_event_date__isnull=False)\
+        .values_list('pk', 'next_event_date', 'next_iteration')
+    VanishingEvent.objects.using(db).bulk_create(
+        (VanishingEvent(vanishing_datetime_id=pk, event_date=event_date,
+                        iteration=iteration)
+         for pk, event_date, iteration in scheduled.iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('privacydates', '0004_vanishingdatetime_dt_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vanishingdatetime',
+            name='next_event_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='vanishingdatetime',
+            name='next_iteration',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(fold_events, unfold_events),
+        migrations.DeleteModel(
+            name='VanishingEvent',
+        ),
+        migrations.AddIndex(
+            model_name='vanishingdatetime',
+            index=models.Index(fields=['next_event_date'], name='privacydates_next_event_idx'),
+        ),
+    ]
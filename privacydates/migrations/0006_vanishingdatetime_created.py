@@ -0,0 +1,19 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('privacydates', '0005_vanishingdatetime_next_event'),
+    ]
+
+    operations = [
+        # Existing dates get the time of the migration, so their grace
+        # period for purgevanishingdates starts now.
+        migrations.AddField(
+            model_name='vanishingdatetime',
+            name='created',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
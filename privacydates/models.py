@@ -1,26 +1,230 @@
 """Auxiliary models for maintaining vanishing dates"""
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import partial
+import threading
 import uuid
 import warnings
-from typing import Optional
+from typing import Dict, Iterable, List, NamedTuple, Optional
 
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.db.models.functions import Trunc
 from django.utils import timezone
 
 from .precision import Precision
 from .policy import PolicyEncoder, PolicyDecoder
 
 
+# maximum number of decoded policies kept per process
+POLICY_CACHE_SIZE = 256
+
+_policy_cache: 'OrderedDict[int, VanishingPolicy]' = OrderedDict()
+_policy_cache_lock = threading.Lock()
+
+
+def _cache_policies(policies: Iterable['VanishingPolicy']) -> None:
+    with _policy_cache_lock:
+        for policy in policies:
+            _policy_cache[policy.pk] = policy
+            _policy_cache.move_to_end(policy.pk)
+        while len(_policy_cache) > POLICY_CACHE_SIZE:
+            _policy_cache.popitem(last=False)
+
+
+class VanishingPolicyManager(models.Manager):
+    """Manager with a bounded process-wide LRU cache of decoded policies.
+
+    Policies are only cached once they are known to be committed, so that
+    rolled back policies never leak into the cache. Cached entries do not
+    expire, which relies on policies being immutable once saved (see
+    VanishingPolicy.save). Cached instances are shared and must not be
+    modified.
+    """
+
+    def get_cached(self, pk: int) -> 'VanishingPolicy':
+        """Return the policy with the given pk, from cache if possible"""
+        return self.get_many_cached([pk])[pk]
+
+    def get_many_cached(self, pks: Iterable[int]) -> Dict[int, 'VanishingPolicy']:
+        """Return a dict mapping the given pks to their policies.
+        Policies missing in the cache are fetched with a single query.
+        """
+        found = {}
+        with _policy_cache_lock:
+            for pk in pks:
+                policy = _policy_cache.get(pk)
+                if policy is not None:
+                    _policy_cache.move_to_end(pk)
+                    found[pk] = policy
+        missing = set(pks) - found.keys()
+        if missing:
+            fetched = self.in_bulk(missing)
+            if len(fetched) < len(missing):
+                raise self.model.DoesNotExist(
+                    "VanishingPolicy %s does not exist"
+                    % sorted(missing - fetched.keys()))
+            found.update(fetched)
+            self.add_cached(fetched.values())
+        return found
+
+    def add_cached(self, policies: Iterable['VanishingPolicy']) -> None:
+        """Add the given policies to the cache once the current transaction
+        commits (immediately in autocommit mode)."""
+        transaction.on_commit(partial(_cache_policies, list(policies)),
+                              using=self.db)
+
+    def clear_cached(self, pk: Optional[int] = None) -> None:
+        """Remove the policy with the given pk or all policies from cache"""
+        with _policy_cache_lock:
+            if pk is None:
+                _policy_cache.clear()
+            else:
+                _policy_cache.pop(pk, None)
+
+
 class VanishingPolicy(models.Model):
     """Model used by VanishingDateTime for storing the rules that
-     specify the VanishingEvents
+     specify the reduction steps
+
+    Policies are immutable once saved: dates are scheduled by the steps of
+    their policy and executors in other processes cache decoded policies.
+    To change the reduction of new dates, create a new policy.
     """
     policy = models.JSONField(encoder=PolicyEncoder, decoder=PolicyDecoder)
     ordering_key = models.CharField(null=True, blank=True, max_length=64)
 
+    objects = VanishingPolicyManager()
+
     class Meta:
         unique_together = ('policy', 'ordering_key',)
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("VanishingPolicy %s is immutable, create a new "
+                             "policy instead" % self.pk)
+        super().save(*args, **kwargs)
+
+
+class Backlog(NamedTuple):
+    """Due vanishing events not yet executed"""
+    pending: int
+    # age of the oldest pending event, None if nothing is pending
+    oldest_age: Optional[timedelta]
+
+
+class VanishingDateTimeQuerySet(models.QuerySet):
+    def due(self, now: Optional[datetime] = None) \
+            -> 'VanishingDateTimeQuerySet':
+        """Return the dates with a policy step scheduled at or before now
+        (default: current time), oldest first. Served by the index on
+        next_event_date."""
+        if now is None:
+            now = timezone.now()
+        return self.filter(next_event_date__lte=now)\
+            .order_by('next_event_date')
+
+    def next_event_date(self) -> Optional[datetime]:
+        """Return the date of the earliest scheduled event, if any"""
+        return self.filter(next_event_date__isnull=False)\
+            .order_by('next_event_date')\
+            .values_list('next_event_date', flat=True).first()
+
+    def backlog(self, now: Optional[datetime] = None) -> Backlog:
+        """Return the number of due events and the age of the oldest one at
+        now (default: current time) with a single query on the
+        next_event_date index, e.g. to alert on executors falling behind."""
+        if now is None:
+            now = timezone.now()
+        result = self.filter(next_event_date__lte=now).aggregate(
+            pending=models.Count('pk'), oldest=models.Min('next_event_date'))
+        oldest = result['oldest']
+        return Backlog(result['pending'],
+                       now - oldest if oldest is not None else None)
+
+    def schedule(self, start: datetime, end: datetime, kind: str = 'hour'):
+        """Return the number of events scheduled after start until end,
+        grouped by policy, iteration and time bucket.
+
+        Parameters
+        ----------
+        kind : str
+            Size of the time buckets, as kind of Trunc ('minute', 'hour',
+            'day', ...)
+
+        Returns
+        -------
+        QuerySet
+            Dictionaries with the keys policy, iteration, bucket (start of
+            the bucket) and count, ordered by bucket
+        """
+        return self.filter(next_event_date__gt=start,
+                           next_event_date__lte=end)\
+            .annotate(
+                bucket=Trunc('next_event_date', kind),
+                policy=models.F('vanishing_policy_id'),
+                iteration=models.F('next_iteration'),
+            ).values('policy', 'iteration', 'bucket')\
+            .annotate(count=models.Count('pk'))\
+            .order_by('bucket', 'policy', 'iteration')
+
+    def bulk_update_schedule(self, vandates: List['VanishingDateTime']) -> int:
+        """Write dt and the scheduled step of the given dates in place.
+
+        On PostgreSQL and SQLite (>= 3.33) the dates are written with one
+        UPDATE ... FROM (VALUES ...) statement per chunk, which avoids the
+        CASE expressions of bulk_update that are costly to build and to
+        evaluate for large batches. Other databases use bulk_update.
+
+        Returns
+        -------
+        int
+            Number of updated dates
+        """
+        fields = ['dt', 'next_event_date', 'next_iteration']
+        self._for_write = True
+        connection = connections[self.db]
+        if not (connection.vendor == 'postgresql' or (
+                connection.vendor == 'sqlite'
+                and connection.Database.sqlite_version_info >= (3, 33))):
+            return self.bulk_update(vandates, fields)
+        opts = self.model._meta
+        columns = [opts.pk] + [opts.get_field(name) for name in fields]
+        if connection.vendor == 'postgresql':
+            # untyped parameters of VALUES would be text
+            placeholders = ["%%s::%s" % field.db_type(connection)
+                            for field in columns]
+        else:
+            placeholders = ["%s"] * len(columns)
+        row = "(%s)" % ", ".join(placeholders)
+        qn = connection.ops.quote_name
+        table = qn(opts.db_table)
+        sql = (
+            "UPDATE {table} SET {assignments}"
+            " FROM (VALUES {rows}) AS v"
+            " WHERE {table}.{pk} = v.column1"
+        )
+        assignments = ", ".join(
+            "%s = v.column%d" % (qn(field.column), i)
+            for i, field in enumerate(columns[1:], start=2))
+        batch_size = connection.ops.bulk_batch_size(columns, vandates)
+        updated = 0
+        with transaction.atomic(using=self.db, savepoint=False), \
+                connection.cursor() as cursor:
+            for start in range(0, len(vandates), batch_size):
+                chunk = vandates[start:start + batch_size]
+                params = [
+                    field.get_db_prep_save(getattr(vandate, field.attname),
+                                           connection)
+                    for vandate in chunk for field in columns
+                ]
+                cursor.execute(sql.format(
+                    table=table, assignments=assignments,
+                    rows=", ".join([row] * len(chunk)),
+                    pk=qn(opts.pk.column),
+                ), params)
+                updated += cursor.rowcount
+        return updated
+
 
 class VanishingDateTime(models.Model):
     """Stores datetime and policy information for a vanishing date
@@ -33,46 +237,47 @@ class VanishingDateTime(models.Model):
     vanishing_policy: VanishingPolicy
         Instance of VanishingPolicy defining the reduction policy
         and controlling the optional ordering context.
+
+    next_event_date: datetime
+        The date and time the next policy step is scheduled at,
+        None once all steps are applied
+
+    next_iteration: int
+        The number of the next policy step
+
+    created: datetime
+        When the date was created, unlike dt not reduced by the policy
     """
     dta_key = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     dt = models.DateTimeField()
     vanishing_policy = models.ForeignKey(VanishingPolicy, on_delete=models.DO_NOTHING)
+    next_event_date = models.DateTimeField(null=True, blank=True)
+    next_iteration = models.IntegerField(null=True, blank=True)
+    created = models.DateTimeField(default=timezone.now, editable=False)
+
+    objects = VanishingDateTimeQuerySet.as_manager()
 
     class Meta:
-        ordering = ('dt', )
+        # No default ordering, which would sort every query by dt.
+        # vanishing_policy is indexed as foreign key.
+        indexes = [
+            models.Index(fields=['dt'], name='privacydates_dt_idx'),
+            models.Index(fields=['next_event_date'],
+                         name='privacydates_next_event_idx'),
+        ]
 
     def __str__(self):
         return str(self.dt)
 
-
-class VanishingEvent(models.Model):
-    """A VanishingEvent represent a single plannend reduction step
-     of one VanishingDateTime instance on a given point of time.
-
-    Parameters
-    ----------
-    vanishing_datetime : VanishingDateTime
-        The VanishingDateTime instance the event is set for
-
-    event_date: datetime
-        The date and time the vanishing event is scheduled at
-
-    iteration: int
-        The step number within the vanishing policy
-    """
-    vanishing_datetime = models.ForeignKey(VanishingDateTime,
-                                           related_name="events",
-                                           on_delete=models.CASCADE)
-    event_date = models.DateTimeField()
-    iteration = models.IntegerField()
-
-    def __repr__(self) -> str:
-        return ("VanishingEvent(vanishing_datetime=%r,"
-                "event_date=%r,iteration=%d)") % (
-                    self.vanishing_datetime,
-                    self.event_date,
-                    self.iteration,
-                )
+    @property
+    def cached_policy(self) -> VanishingPolicy:
+        """The vanishing_policy, taken from the process-wide policy cache
+        unless already loaded."""
+        field = self._meta.get_field('vanishing_policy')
+        if not field.is_cached(self):
+            self.vanishing_policy = VanishingPolicy.objects.get_cached(
+                self.vanishing_policy_id)
+        return self.vanishing_policy
 
 
 class BasicOrderingContext(models.Model):
@@ -94,7 +299,27 @@ class BasicOrderingContext(models.Model):
         int
             lowest unused number of the context
         """
+        return self._next_many(1, max_count, reset_precision,
+                               similarity_precision)[0]
+
+    def _next_many(self, amount: int, max_count: int,
+                   reset_precision: Optional[Precision] = None,
+                   similarity_precision: Optional[Precision] = None
+                   ) -> List[int]:
+        """Get the next amount counts with a single save.
+        The counts equal those of amount consecutive calls of _next.
+        """
         now = timezone.now()
+        counts = [self._advance(now, max_count, reset_precision,
+                                similarity_precision)
+                  for _ in range(amount)]
+        self.save()
+        return counts
+
+    def _advance(self, now: datetime, max_count: int,
+                 reset_precision: Optional[Precision] = None,
+                 similarity_precision: Optional[Precision] = None) -> int:
+        """Advance the counter for a count assigned at now (without saving)"""
         rough_now: Optional[datetime] = None
         if similarity_precision:
             rough_now = similarity_precision.apply(now)
@@ -117,13 +342,110 @@ class BasicOrderingContext(models.Model):
         if impending_overflow:
             warnings.warn("Overflow in ordering counter %s" % self.context_key)
             self.last_count = max_count
-        self.save()
         return self.last_count
 
     class Meta:
         abstract = True
 
 
+class OrderingContextManager(models.Manager):
+    """Manager allocating ordering numbers with a single atomic statement"""
+
+    def next_count(self, context_key: str, similarity_distance: int = 0) -> int:
+        """Get the next count of the context with the given key, creating the
+        context if necessary.
+
+        On PostgreSQL and SQLite (>= 3.35) the context is created or
+        incremented with one upsert statement, which also evaluates the
+        similarity time slot using the database clock. Other databases lock
+        the context row while the next count is determined.
+
+        Returns
+        -------
+        int
+            lowest unused number of the context
+        """
+        return self.next_counts(context_key, 1, similarity_distance)[0]
+
+    def next_counts(self, context_key: str, amount: int,
+                    similarity_distance: int = 0) -> List[int]:
+        """Get the next amount counts of the context with the given key with
+        a single statement, as for amount consecutive calls of next_count.
+        Without similarity distance these are consecutive numbers.
+        """
+        if amount <= 0:
+            raise ValueError("amount must be positive")
+        using = self._db or router.db_for_write(self.model, **self._hints)
+        connection = connections[using]
+        if connection.vendor == 'postgresql' or (
+                connection.vendor == 'sqlite'
+                and connection.Database.sqlite_version_info >= (3, 35)):
+            return self._upsert_next_counts(connection, context_key, amount,
+                                            similarity_distance)
+        with transaction.atomic(using=using):
+            context, _ = self.using(using).select_for_update().get_or_create(
+                context_key=context_key,
+                defaults={'similarity_distance': similarity_distance},
+            )
+            return context._next_locked(amount, similarity_distance)
+
+    def release_counts(self, context_key: str, first_unused: int,
+                       last_reserved: int) -> bool:
+        """Give back the unused end of a reserved range of counts, unless
+        further counts were allocated in the meantime.
+        Return whether the counts were released.
+        """
+        return bool(self.filter(
+            context_key=context_key,
+            last_count=last_reserved,
+        ).update(last_count=first_unused - 1))
+
+    def _upsert_next_counts(self, connection, context_key: str, amount: int,
+                            similarity_distance: int) -> List[int]:
+        if not similarity_distance:
+            slot = "NULL"
+        elif connection.vendor == 'postgresql':
+            slot = ("to_timestamp(floor(extract(epoch from "
+                    "statement_timestamp()) / %(distance)s) * %(distance)s)")
+        else:
+            slot = ("datetime((CAST(strftime('%%%%s', 'now') AS INTEGER)"
+                    " / %(distance)s) * %(distance)s, 'unixepoch')")
+        slot = slot % {'distance': int(similarity_distance)}
+        # within a similarity slot all counts are the same
+        step = 1 if similarity_distance else amount
+        qn = connection.ops.quote_name
+        sql = (
+            "INSERT INTO {table} AS ctx"
+            " ({key}, {count}, {date}, {distance})"
+            " VALUES (%s, %s, {slot}, %s)"
+            " ON CONFLICT ({key}) DO UPDATE SET"
+            " {count} = CASE"
+            "  WHEN excluded.{date} IS NOT NULL"
+            "   AND ctx.{date} = excluded.{date} THEN ctx.{count}"
+            "  WHEN ctx.{count} > %s THEN %s"
+            "  ELSE ctx.{count} + %s END,"
+            " {date} = excluded.{date}"
+            " RETURNING {count}"
+        ).format(
+            table=qn(self.model._meta.db_table),
+            key=qn('context_key'),
+            count=qn('last_count'),
+            date=qn('last_date'),
+            distance=qn('similarity_distance'),
+            slot=slot,
+        )
+        max_count = self.model.MAX_COUNT
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [context_key, step, similarity_distance,
+                                 max_count - step, max_count, step])
+            last = cursor.fetchone()[0]
+        if last >= max_count:
+            warnings.warn("Overflow in ordering counter %s" % context_key)
+        if similarity_distance:
+            return [last] * amount
+        return list(range(last - amount + 1, last + 1))
+
+
 class OrderingContext(BasicOrderingContext):
     """Model managing Ordering
 
@@ -146,21 +468,35 @@ class OrderingContext(BasicOrderingContext):
 
     similarity_distance = models.PositiveIntegerField(default=0)
 
+    objects = OrderingContextManager()
+
     def next(self) -> int:
         """Get the next count (lowest unused).
         If similarity_distance is >0, the same count is given for timestamps in
         the same rouged time slot.
 
+        The count is allocated atomically in the database (see
+        OrderingContextManager.next_count) and the instance is refreshed.
+
         Returns
         -------
         int
             lowest unused number of the context
         """
-        if self.similarity_distance > 0:
-            precision = Precision(seconds=self.similarity_distance)
+        count = type(self).objects.db_manager(self._state.db).next_count(
+            self.context_key, self.similarity_distance)
+        self.refresh_from_db(fields=['last_count', 'last_date'])
+        return count
+
+    def _next_locked(self, amount: int, similarity_distance: int) -> List[int]:
+        """Get the next amount counts of the locked instance with the given
+        similarity distance"""
+        if similarity_distance > 0:
+            precision = Precision(seconds=similarity_distance)
         else:
             precision = None
-        return self._next(self.MAX_COUNT, similarity_precision=precision)
+        return self._next_many(amount, self.MAX_COUNT,
+                               similarity_precision=precision)
 
 
 class VanishingOrderingContext(BasicOrderingContext):
@@ -198,3 +534,11 @@ class VanishingOrderingContext(BasicOrderingContext):
         """
         last_precision: Precision = policy.policy[-1]  # last reduction step
         return self._next(self.MAX_COUNT, reset_precision=last_precision)
+
+    def next_many(self, policy: VanishingPolicy, amount: int) -> List[int]:
+        """Get the next amount counts at once, as for amount consecutive
+        calls of next.
+        """
+        last_precision: Precision = policy.policy[-1]  # last reduction step
+        return self._next_many(amount, self.MAX_COUNT,
+                               reset_precision=last_precision)
@@ -1,7 +1,119 @@
 """Utilities for ordering contexts"""
 from hashlib import sha256
+import os
+import threading
+from typing import Dict, Tuple
+import weakref
+
+from django.db import connections, router, transaction
+
+from .models import OrderingContext
 
 
 def hash_context_key(key: str) -> str:
     """Return a 64 character hashed context key using SHA256"""
     return sha256(str(key).encode()).hexdigest()
+
+
+_allocators: 'weakref.WeakSet[OrderingBlockAllocator]' = weakref.WeakSet()
+
+
+class _BlockReservation:
+    """on_commit callback marking the reservation of a block as committed"""
+    __slots__ = ('committed',)
+
+    def __init__(self):
+        self.committed = False
+
+    def __call__(self):
+        self.committed = True
+
+    def is_valid(self, using: str) -> bool:
+        """Whether the reservation is committed or still pending in the
+        current transaction of using, i.e. was not rolled back."""
+        if self.committed:
+            return True
+        # Django discards the on_commit callbacks of rolled back
+        # transactions and savepoints.
+        return any(entry[1] is self
+                   for entry in connections[using].run_on_commit)
+
+
+class OrderingBlockAllocator:
+    """Hands out ordering numbers from blocks reserved per process.
+
+    Each block of block_size consecutive counts is reserved with a single
+    update of the context. Numbers are strictly increasing within a process,
+    but processes interleave and unused numbers of a block leave gaps.
+    Only suitable for contexts without similarity distance.
+
+    A block reserved inside a transaction is only handed out in that
+    transaction until it commits. If the reservation is rolled back, the
+    rest of the block is dropped, as its numbers may be reserved again.
+
+    Blocks are reserved without holding the allocator's lock, so a thread
+    waiting for the row lock of another thread's transaction does not block
+    that transaction. Blocks reserved concurrently for the same context
+    leave the unused counts of all but the most recent one as gaps.
+    """
+
+    def __init__(self, block_size: int) -> None:
+        if block_size <= 0:
+            raise ValueError("block_size must be positive")
+        self.block_size = block_size
+        # maps (database, context_key) to
+        # [next count, last reserved count, reservation]
+        self._blocks: Dict[Tuple[str, str], list] = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        _allocators.add(self)
+
+    def next(self, context_key: str) -> int:
+        """Get the next count of the context with the given key"""
+        using = router.db_for_write(OrderingContext)
+        with self._lock:
+            if self._pid != os.getpid():
+                # blocks must not be shared with forked processes
+                self._blocks.clear()
+                self._pid = os.getpid()
+            block = self._blocks.get((using, context_key))
+            if (block is not None and block[0] <= block[1]
+                    and block[2].is_valid(using)):
+                count = block[0]
+                block[0] += 1
+                return count
+        # Reserved without holding the lock: the update may wait for the row
+        # lock of another thread's transaction, which may need the lock
+        # before it can commit.
+        counts = OrderingContext.objects.db_manager(using).next_counts(
+            context_key, self.block_size)
+        reservation = _BlockReservation()
+        # runs immediately in autocommit mode
+        transaction.on_commit(reservation, using=using)
+        with self._lock:
+            block = self._blocks.get((using, context_key))
+            # a block reserved concurrently by another thread may be more
+            # recent, it is kept so that handed out counts keep increasing
+            if block is None or block[1] < counts[-1]:
+                self._blocks[(using, context_key)] = \
+                    [counts[0] + 1, counts[-1], reservation]
+        return counts[0]
+
+    def release(self) -> None:
+        """Give back the unused counts of all blocks, where no other process
+        reserved counts since, and forget all blocks."""
+        with self._lock:
+            blocks = self._blocks if self._pid == os.getpid() else {}
+            self._blocks = {}
+        for (using, context_key), (first, last, reservation) \
+                in blocks.items():
+            if first <= last and reservation.is_valid(using):
+                OrderingContext.objects.db_manager(using).release_counts(
+                    context_key, first, last)
+
+
+def release_ordering_blocks() -> None:
+    """Release the reserved blocks of all OrderingBlockAllocator instances,
+    e.g. on process shutdown."""
+    for allocator in list(_allocators):
+        allocator.release()
@@ -1,6 +1,14 @@
 """Date precision utilities"""
-from datetime import datetime, timedelta, timezone
-from typing import Dict, Optional
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
 
 
 class Precision:
@@ -12,6 +20,10 @@ class Precision:
         years, or as multiples of calendar-independ time units like days or
         hours.
 
+        Month precisions reduce to the first month of buckets starting in
+        January, e.g. months=3 to the quarters starting in January, April,
+        July and October.
+
         Calendar dependent and independent precision values can not be combined.
         """
         # first check calendar independent units
@@ -42,20 +54,80 @@ class Precision:
         self.months = months
         self.years = years
         self.apply_after_seconds: Optional[int] = after_seconds or None
+        # first month of the bucket for each month (index 0 unused)
+        self._first_months = tuple(
+            ((month - 1) // months) * months + 1 if months else month
+            for month in range(13)
+        )
 
     def apply(self, dt: datetime) -> datetime:
         """Apply the precision level to the given date and return the reduced
         date."""
         if self.seconds:
-            return reduce_precision(dt, self.seconds)
-        dt = dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            return _reduce_seconds(dt, self.seconds)
         if self.months:
-            return dt.replace(month=(dt.month // self.months)*self.months)
+            return dt.replace(month=self._first_months[dt.month], day=1,
+                              hour=0, minute=0, second=0, microsecond=0)
         if self.years:
-            dt = dt.replace(month=1)
-            return dt.replace(year=(dt.year // self.years)*self.years)
+            return dt.replace(year=dt.year - dt.year % self.years, month=1,
+                              day=1, hour=0, minute=0, second=0,
+                              microsecond=0)
         raise RuntimeError("Unexpected precision")
 
+    def apply_many(self, dts):
+        """Apply the precision level to many dates at once.
+
+        Dates can be given as a sequence of datetimes, which returns a list of
+        reduced datetimes. Or as NumPy array of datetime64 values or int64
+        POSIX timestamps in seconds, which is reduced with vectorized
+        operations and returned as array of the same dtype. Array values are
+        taken as local wall-clock times, like the naive datetimes they
+        represent.
+        """
+        if np is not None and isinstance(dts, np.ndarray):
+            return self._apply_array(dts)
+        if self.seconds:
+            return reduce_precision_many(dts, self.seconds)
+        return [self.apply(dt) for dt in dts]
+
+    def _apply_array(self, values: 'np.ndarray') -> 'np.ndarray':
+        if self.seconds:
+            return reduce_precision_many(values, self.seconds)
+        if values.dtype.kind in 'iu':
+            # epoch seconds
+            reduced = self._apply_array(values.astype('datetime64[s]'))
+            return reduced.astype(values.dtype)
+        if values.dtype.kind != 'M':
+            raise TypeError("array must hold datetime64 or int values (was %s)"
+                            % values.dtype)
+        if self.months:
+            months = values.astype('datetime64[M]').astype(np.int64)
+            years, month = np.divmod(months, 12)
+            reduced = (years * 12 + (month // self.months) * self.months)\
+                .astype('datetime64[M]')
+        elif self.years:
+            years = values.astype('datetime64[Y]').astype(np.int64) + 1970
+            reduced = ((years // self.years) * self.years - 1970)\
+                .astype('datetime64[Y]')
+        else:
+            raise RuntimeError("Unexpected precision")
+        return _keep_nat(values, reduced.astype(values.dtype))
+
+    def as_expression(self, field_name):
+        """Return a Django expression that applies the precision level to the
+        given field (name or expression) inside the database.
+
+        This allows set-based reductions like
+        ``Model.objects.update(dt=precision.as_expression('dt'))``.
+        Supported on SQLite and PostgreSQL.
+        """
+        from django.db.models import F
+
+        from .expressions import ReducePrecision
+        if isinstance(field_name, str):
+            field_name = F(field_name)
+        return ReducePrecision(field_name, self)
+
     def after(self, seconds=0, minutes=0, hours=0, days=0, weeks=0) -> 'Precision':
         """Set a delay after which the precision should be applied.
         This is for usage in combination with VanishingDate.
@@ -137,12 +209,87 @@ def reduce_precision(dt: datetime, reduction_divisor: int) -> datetime:
                         % type(reduction_divisor))
     if reduction_divisor <= 0:
         raise ValueError("reduction_divisor must be positive")
-    # pretend timestamp is UTC avoid offset ajustment when calculating
-    # POSIX timestamp. Otherwise we would reduce the UTC value.
-    reduced_unixtime = (
-        (int(dt.replace(tzinfo=timezone.utc).timestamp())
-         // reduction_divisor) * reduction_divisor
-    )
-
-    # carry over tzinfo if existant
-    return datetime.utcfromtimestamp(reduced_unixtime).replace(tzinfo=dt.tzinfo)
+    return _reduce_seconds(dt, reduction_divisor)
+
+
+def _reduce_seconds(dt: datetime, reduction_divisor: int) -> datetime:
+    """reduce_precision without argument checks"""
+    # Count seconds of the local wall-clock time since the epoch, as if the
+    # timestamp was UTC. Otherwise we would reduce the UTC value.
+    seconds = ((dt.toordinal() - _EPOCH_ORDINAL) * 86400
+               + dt.hour * 3600 + dt.minute * 60 + dt.second)
+    truncated = seconds
+    if seconds < 0 and dt.microsecond:
+        # round towards zero like int() of a negative POSIX timestamp
+        truncated += 1
+    reduced = truncated - truncated % reduction_divisor
+    # subtracting keeps tzinfo if existant
+    return dt - timedelta(seconds=seconds - reduced,
+                          microseconds=dt.microsecond)
+
+
+def reduce_precision_many(dts, reduction_divisor: int):
+    """Reduces the precision of many datetimes to multiples of the given
+    reduction divisor in seconds, with the same results as reduce_precision.
+
+    Parameters
+    ----------
+    dts : sequence of datetime.datetime or numpy.ndarray
+        The datetimes which should be reduced. NumPy arrays may hold
+        datetime64 values or int64 POSIX timestamps in seconds and are reduced
+        with vectorized operations.
+    reduction_divisor : int
+        The value that indicates the precision level in seconds
+
+    Returns
+    -------
+    list of datetime.datetime or numpy.ndarray
+        The reduced datetimes, as array of the input dtype for arrays
+    """
+    if not isinstance(reduction_divisor, int):
+        raise TypeError("reduction_divisor must be int (was %s)"
+                        % type(reduction_divisor))
+    if reduction_divisor <= 0:
+        raise ValueError("reduction_divisor must be positive")
+    if np is not None and isinstance(dts, np.ndarray):
+        return _reduce_array(dts, reduction_divisor)
+    return _reduce_sequence(dts, reduction_divisor)
+
+
+def _reduce_sequence(dts: Sequence[datetime],
+                     reduction_divisor: int) -> List[datetime]:
+    reduced = []
+    for dt in dts:
+        if not isinstance(dt, datetime):
+            raise TypeError("dt must be datetime (was %s)" % type(dt))
+        reduced.append(_reduce_seconds(dt, reduction_divisor))
+    return reduced
+
+
+def _reduce_array(values: 'np.ndarray', reduction_divisor: int) -> 'np.ndarray':
+    if values.dtype.kind in 'iu':
+        # whole epoch seconds
+        return (values // reduction_divisor) * reduction_divisor
+    if values.dtype.kind != 'M':
+        raise TypeError("array must hold datetime64 or int values (was %s)"
+                        % values.dtype)
+    unit, _ = np.datetime_data(values.dtype)
+    if unit in ('Y', 'M', 'W', 'D', 'h', 'm', 's', 'generic'):
+        seconds = values.astype('datetime64[s]').astype(np.int64)
+    else:
+        # sub-second units are truncated towards zero like int(timestamp)
+        ticks = values.astype(np.int64)
+        per_second = int(np.timedelta64(1, 's') / np.timedelta64(1, unit))
+        seconds = np.where(ticks < 0, -(-ticks // per_second),
+                           ticks // per_second)
+    reduced = (seconds // reduction_divisor) * reduction_divisor
+    return _keep_nat(values, reduced.astype('datetime64[s]')
+                     .astype(values.dtype))
+
+
+def _keep_nat(values: 'np.ndarray', reduced: 'np.ndarray') -> 'np.ndarray':
+    """Restore NaT values of the input in the reduced array"""
+    nat = np.isnat(values)
+    if nat.any():
+        reduced[nat] = np.datetime64('NaT')
+    return reduced
@@ -1,41 +1,159 @@
 """Signals for maintaining vanishing dates"""
-from django.db import transaction
-from django.db.models.signals import post_save
+from contextlib import contextmanager
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+from django.apps import apps
+from django.db import connections, transaction
+from django.db.models import Exists, OuterRef, QuerySet
+from django.db.models.signals import post_delete, pre_save
 from django.dispatch import receiver
 
-from .vanish import event_creator
-from .models import VanishingDateTime, VanishingOrderingContext
-from .precision import Precision
-
-
-@receiver(post_save, sender=VanishingDateTime)
-@transaction.atomic
-def create_initial_vanishing_event(sender, instance, created, **kwargs):
-    """Create initial VanishingEvent for newly saved vanishing dates"""
-    if not created:
-        return  # no nothing
-
-    # Check if first precision should be applied immediately
-    # If so, do and start event_creator with iteration 1.
-    first_precision: Precision = instance.vanishing_policy.policy[0]
-    if first_precision.is_applied_immediately():
-        instance.dt = first_precision.apply(instance.dt)
-        if len(instance.vanishing_policy.policy) > 1:
-            event_creator(instance, iteration=1)
-    else:
-        event_creator(instance, iteration=0)
+from .fields import VanishingDateField
+from .vanish import apply_initial_step, clear_policy_registry
+from .models import (
+    VanishingDateTime,
+    VanishingOrderingContext,
+    VanishingPolicy,
+)
+
 
-    enum_key = instance.vanishing_policy.ordering_key
+@receiver(pre_save, sender=VanishingDateTime)
+def prepare_vanishing_datetime(sender, instance, raw, **kwargs):
+    """Apply the immediate policy step and the ordering count to new
+    vanishing dates before they are written, so that creation takes a single
+    INSERT."""
+    if raw or not instance._state.adding:
+        return
+
+    # Apply first precision if it applies immediately and plan the next step.
+    apply_initial_step(instance)
+
+    policy = instance.cached_policy
+    enum_key = policy.ordering_key
     if enum_key is not None:
         # Use microseconds for ordering.
         context, _ = VanishingOrderingContext.objects.get_or_create(context_key=enum_key)
-        count = context.next(instance.vanishing_policy)
+        count = context.next(policy)
         instance.dt = instance.dt.replace(microsecond=count)
-    instance.save()
 
 
-def delete_datetime_of_deleted_parent(sender, instance, **kwargs):
+@receiver(post_delete, sender=VanishingPolicy)
+def invalidate_cached_policy(sender, instance, **kwargs):
+    """Drop deleted policies from the policy cache"""
+    VanishingPolicy.objects.clear_cached(instance.pk)
+    clear_policy_registry(instance.pk)
+
+
+# attnames of the VanishingDateFields of VanishingDateMixIn models,
+# filled by PrivacydatesConfig.ready
+vanishing_date_attnames: Dict[type, Tuple[str, ...]] = {}
+
+# pks of VanishingDateTimes collected by deferred_vanishing_deletion
+_deferred = threading.local()
+
+
+def delete_datetime_of_deleted_parent(sender, instance, using, **kwargs):
     """Delete all VanishingDateTime in relation with the given instance"""
-    for field in instance._meta.get_fields():
-        if isinstance(getattr(instance, field.name), VanishingDateTime):
-            getattr(instance, field.name).delete()
+    pks = [getattr(instance, attname)
+           for attname in vanishing_date_attnames[sender]]
+    pks = [pk for pk in pks if pk is not None]
+    collected = getattr(_deferred, 'pks', None)
+    if collected is not None and using in collected:
+        collected[using].extend(pks)
+    else:
+        delete_vanishing_datetimes(pks, using)
+
+
+@contextmanager
+def deferred_vanishing_deletion(using: str):
+    """Collect the VanishingDateTimes of parents deleted in this block and
+    delete them together at its end, instead of one by one per parent.
+    """
+    collected = getattr(_deferred, 'pks', None)
+    if collected is not None and using in collected:
+        # nested block, the outer one deletes
+        yield
+        return
+    if collected is None:
+        collected = _deferred.pks = {}
+    collected[using] = []
+    try:
+        with transaction.atomic(using=using):
+            yield
+            delete_vanishing_datetimes(collected[using], using)
+    finally:
+        del collected[using]
+        if not collected:
+            del _deferred.pks
+
+
+def vanishing_date_fields() -> List[VanishingDateField]:
+    """All VanishingDateFields of installed models"""
+    return [
+        field
+        for model in apps.get_models()
+        if not model._meta.proxy
+        for field in model._meta.concrete_fields
+        if isinstance(field, VanishingDateField)
+    ]
+
+
+def unreferenced(dates: QuerySet) -> QuerySet:
+    """Filter dates to those not referenced by any VanishingDateField, with
+    one NOT EXISTS anti-join per field."""
+    for field in vanishing_date_fields():
+        references = field.model._base_manager.filter(
+            **{field.attname: OuterRef('pk')})
+        dates = dates.filter(~Exists(references))
+    return dates
+
+
+# anti-joins of unreferenced() as SQL condition per database alias
+_unreferenced_conditions: Dict[str, str] = {}
+
+
+def _unreferenced_condition(using: str) -> str:
+    """SQL condition of the anti-joins of unreferenced(), for a DELETE of
+    VanishingDateTimes. Built once per database, as compiling the
+    subqueries with the ORM would dominate the deletion of single dates."""
+    condition = _unreferenced_conditions.get(using)
+    if condition is None:
+        qn = connections[using].ops.quote_name
+        opts = VanishingDateTime._meta
+        date_pk = "%s.%s" % (qn(opts.db_table), qn(opts.pk.column))
+        condition = "".join(
+            " AND NOT EXISTS (SELECT 1 FROM {table}"
+            " WHERE {table}.{column} = {date_pk})".format(
+                table=qn(field.model._meta.db_table),
+                column=qn(field.column), date_pk=date_pk)
+            for field in vanishing_date_fields())
+        _unreferenced_conditions[using] = condition
+    return condition
+
+
+def delete_vanishing_datetimes(pks: Iterable, using: str) -> None:
+    """Delete VanishingDateTimes by pk without fetching them, with one
+    DELETE per chunk.
+
+    Dates still referenced by another object are kept, e.g. a date assigned
+    to several fields, as their deletion would have to cascade.
+    """
+    pks: List = list(pks)
+    if not pks:
+        return
+    connection = connections[using]
+    opts = VanishingDateTime._meta
+    qn = connection.ops.quote_name
+    sql = "DELETE FROM {table} WHERE {table}.{pk} IN ({placeholders}){cond}"
+    batch_size = connection.ops.bulk_batch_size(['pk'], pks)
+    # Parents are deleted already, so the dates are not fetched.
+    with transaction.atomic(using=using, savepoint=False), \
+            connection.cursor() as cursor:
+        for start in range(0, len(pks), batch_size):
+            chunk = pks[start:start + batch_size]
+            cursor.execute(sql.format(
+                table=qn(opts.db_table), pk=qn(opts.pk.column),
+                placeholders=", ".join(["%s"] * len(chunk)),
+                cond=_unreferenced_condition(using),
+            ), [opts.pk.get_db_prep_value(pk, connection) for pk in chunk])
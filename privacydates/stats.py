@@ -0,0 +1,167 @@
+"""Statistics of vanishing executor runs"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Iterable, List, Optional, Sequence
+
+from django.db import connections
+from django.dispatch import Signal
+
+from .models import Backlog
+
+
+__all__ = [
+    'Histogram', 'VanishingRunStats', 'vanishing_run_finished',
+]
+
+# Sent by update_vanishing and aupdate_vanishing after each run,
+# with the VanishingRunStats of the run as argument stats.
+vanishing_run_finished = Signal()
+
+# upper bounds of the histogram buckets in seconds
+LAG_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, 6 * 3600, 24 * 3600)
+BATCH_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+
+class Histogram:
+    """Histogram of observed values with fixed bucket bounds, like a
+    Prometheus histogram."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # the last count is for values above all bounds
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def merge(self, other: 'Histogram') -> None:
+        if other.buckets != self.buckets:
+            raise ValueError("Histograms have different buckets")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+
+
+class VanishingRunStats:
+    """Counters and latencies of executor runs.
+
+    Attributes
+    ----------
+    events : int
+        Number of executed events
+    skipped : int
+        Number of events already executed or claimed by another executor
+    batches : int
+        Number of batches (or single events) executed
+    queries : int
+        Number of database queries issued
+    seconds : float
+        Duration of the run
+    lag : Histogram
+        Delay between the scheduled and the actual execution of events in
+        seconds
+    batch_seconds : Histogram
+        Duration of the batches in seconds
+    """
+
+    def __init__(self):
+        self.events = 0
+        self.skipped = 0
+        self.batches = 0
+        self.queries = 0
+        self.seconds = 0.0
+        self.lag = Histogram(LAG_BUCKETS)
+        self.batch_seconds = Histogram(BATCH_BUCKETS)
+
+    def __repr__(self):
+        return "<VanishingRunStats events=%d skipped=%d batches=%d " \
+               "queries=%d seconds=%.3f>" % (
+                   self.events, self.skipped, self.batches, self.queries,
+                   self.seconds)
+
+    def observe_events(self, lags: Iterable[float]) -> None:
+        """Count executed events with their lag in seconds."""
+        for lag in lags:
+            self.events += 1
+            self.lag.observe(lag)
+
+    def observe_batch(self, seconds: float) -> None:
+        """Count an executed batch with its duration."""
+        self.batches += 1
+        self.batch_seconds.observe(seconds)
+
+    @contextmanager
+    def count_queries(self, using: str):
+        """Count the queries issued on the connection using."""
+        def count_query(execute, sql, params, many, context):
+            self.queries += 1
+            return execute(sql, params, many, context)
+
+        with connections[using].execute_wrapper(count_query):
+            yield
+
+    def merge(self, other: 'VanishingRunStats') -> None:
+        """Add the counters of another run, e.g. of a parallel worker."""
+        self.events += other.events
+        self.skipped += other.skipped
+        self.batches += other.batches
+        self.queries += other.queries
+        self.seconds += other.seconds
+        self.lag.merge(other.lag)
+        self.batch_seconds.merge(other.batch_seconds)
+
+    def to_prometheus(self, backlog: Optional[Backlog] = None) -> str:
+        """Format the stats (and optionally the backlog) in the Prometheus
+        text exposition format."""
+        lines = []
+
+        def metric(name, kind, help_text, value):
+            name = 'privacydates_vanishing_' + name
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            lines.append("%s %s" % (name, _number(value)))
+
+        def histogram(name, help_text, hist):
+            name = 'privacydates_vanishing_' + name
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s histogram" % name)
+            cumulative = 0
+            bounds = [_number(b) for b in hist.buckets] + ['+Inf']
+            for bound, count in zip(bounds, hist.counts):
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %d' % (
+                    name, bound, cumulative))
+            lines.append("%s_sum %s" % (name, _number(hist.sum)))
+            lines.append("%s_count %d" % (name, cumulative))
+
+        metric('events_total', 'counter', 'Executed vanishing events',
+               self.events)
+        metric('skipped_events_total', 'counter',
+               'Events executed by another executor', self.skipped)
+        metric('batches_total', 'counter', 'Executed batches', self.batches)
+        metric('queries_total', 'counter', 'Issued database queries',
+               self.queries)
+        metric('run_seconds_total', 'counter', 'Duration of the runs',
+               self.seconds)
+        histogram('lag_seconds',
+                  'Delay between scheduled and actual execution of events',
+                  self.lag)
+        histogram('batch_seconds', 'Duration of batches',
+                  self.batch_seconds)
+        if backlog is not None:
+            metric('backlog_events', 'gauge', 'Due events not yet executed',
+                   backlog.pending)
+            oldest = backlog.oldest_age
+            metric('backlog_oldest_seconds', 'gauge',
+                   'Age of the oldest due event',
+                   oldest.total_seconds() if oldest is not None else 0)
+        return "\n".join(lines) + "\n"
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
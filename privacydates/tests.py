@@ -1,19 +1,44 @@
+import asyncio
+from io import StringIO
 from random import randint
+import threading
 import time
-from datetime import timedelta
+from datetime import datetime, timedelta
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from asgiref.sync import sync_to_async
+from django.contrib import admin
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, transaction
 from django.test import TestCase
 from django.utils import timezone
 
+from .asgi import VanishingLifespanMiddleware
 from .models import (
     OrderingContext,
     VanishingDateTime,
     VanishingOrderingContext,
     VanishingPolicy,
 )
-from .order import hash_context_key
-from .precision import Precision, reduce_precision
-from .vanish import VanishingFactory, make_policy
+from .fields import OrderingDateField
+from .management.commands import vanishdates
+from .order import OrderingBlockAllocator, hash_context_key
+from .precision import Precision, reduce_precision, reduce_precision_many
+from .stats import vanishing_run_finished
+from .vanish import (
+    BUSY_RETRY_INTERVAL,
+    VanishingFactory,
+    aupdate_vanishing,
+    clear_policy_registry,
+    execute_event,
+    make_policy,
+    seconds_until_next_run,
+    update_vanishing,
+)
 
 
 class RoughDateTestCase(TestCase):
@@ -57,6 +82,99 @@ class RoughDateTestCase(TestCase):
             self.assertLessEqual(r_diff, timedelta(seconds=reduction_value))
 
 
+    def test_precision_apply_many(self):
+        precisions = [
+            Precision(seconds=1), Precision(minutes=15), Precision(hours=1),
+            Precision(days=1), Precision(weeks=1), Precision(seconds=7),
+            Precision(months=1), Precision(months=3), Precision(months=12),
+            Precision(years=1), Precision(years=10),
+        ]
+        start = datetime(1969, 12, 31, 23, 59, 59, 500000)
+        dts = [start + timedelta(seconds=randint(0, 10**9),
+                                 microseconds=randint(0, 999999))
+               for _ in range(50)] + [start]
+        aware = [timezone.make_aware(dt, timezone.get_fixed_timezone(60))
+                 for dt in dts]
+        for precision in precisions:
+            for values in (dts, aware):
+                self.assertEqual(precision.apply_many(values),
+                                 [precision.apply(dt) for dt in values])
+            if np is None:
+                continue
+            expected = [precision.apply(dt) for dt in dts]
+            for unit in ('us', 'ns', 's'):
+                array = np.array(dts, dtype='datetime64[%s]' % unit)
+                if unit == 's':
+                    expected = [precision.apply(dt.replace(microsecond=0))
+                                for dt in dts]
+                reduced = precision.apply_many(array)
+                self.assertEqual(reduced.dtype, array.dtype)
+                self.assertEqual(reduced.astype('datetime64[us]').tolist(),
+                                 expected)
+            epochs = array.astype(np.int64)
+            self.assertEqual(precision.apply_many(epochs).tolist(),
+                             reduced.astype(np.int64).tolist())
+        with self.assertRaises(TypeError):
+            reduce_precision_many([0], 60)
+        with self.assertRaises(ValueError):
+            reduce_precision_many([], 0)
+
+
+    def test_precision_month_buckets(self):
+        # first month of the bucket of each month, buckets start in January
+        expected = {
+            2: [1, 1, 3, 3, 5, 5, 7, 7, 9, 9, 11, 11],
+            3: [1, 1, 1, 4, 4, 4, 7, 7, 7, 10, 10, 10],
+            6: [1, 1, 1, 1, 1, 1, 7, 7, 7, 7, 7, 7],
+            12: [1] * 12,
+        }
+        dts = [datetime(2021, month, 15, 13, 37) for month in range(1, 13)]
+        policy = make_policy([Precision(seconds=1)])
+        vandates = VanishingDateTime.objects.bulk_create([
+            VanishingDateTime(dt=dt, vanishing_policy=policy) for dt in dts
+        ])
+        pks = [vandate.pk for vandate in vandates]
+        for months, first_months in expected.items():
+            precision = Precision(months=months)
+            reduced = [datetime(2021, month, 1) for month in first_months]
+            self.assertEqual([precision.apply(dt) for dt in dts], reduced)
+            self.assertEqual(precision.apply_many(dts), reduced)
+            if np is not None:
+                array = np.array(dts, dtype='datetime64[us]')
+                self.assertEqual(
+                    precision.apply_many(array).tolist(), reduced)
+            with transaction.atomic():
+                VanishingDateTime.objects.update(
+                    dt=precision.as_expression('dt'))
+                in_db = VanishingDateTime.objects.in_bulk(pks)
+                transaction.set_rollback(True)
+            self.assertEqual([in_db[pk].dt for pk in pks], reduced)
+
+    def test_precision_as_expression(self):
+        policy = make_policy([Precision(seconds=1)])
+        start = timezone.now() - timedelta(days=5000)
+        dts = [start + timedelta(seconds=randint(0, 10**9),
+                                 microseconds=randint(0, 999999))
+               for _ in range(20)]
+        dts.append(dts[0].replace(year=1969, month=12, day=31, hour=23,
+                                  minute=59, second=59))
+        vandates = VanishingDateTime.objects.bulk_create([
+            VanishingDateTime(dt=dt, vanishing_policy=policy) for dt in dts
+        ])
+        pks = [vandate.pk for vandate in vandates]
+        for precision in (
+                Precision(minutes=15), Precision(days=1), Precision(seconds=7),
+                Precision(months=1), Precision(months=3),
+                Precision(years=1), Precision(years=10)):
+            with transaction.atomic():
+                VanishingDateTime.objects.update(
+                    dt=precision.as_expression('dt'))
+                reduced = VanishingDateTime.objects.in_bulk(pks)
+                transaction.set_rollback(True)
+            self.assertEqual([reduced[pk].dt for pk in pks],
+                             [precision.apply(dt) for dt in dts])
+
+
 class OrderingContextTestCase(TestCase):
 
     def test_ordering_context(self):
@@ -78,6 +196,90 @@ class OrderingContextTestCase(TestCase):
         self.assertTrue(first == second or second == third)
         self.assertNotEqual(third, fourth)
 
+    def test_next_count(self):
+        for expected in range(1, 4):
+            with self.assertNumQueries(1):
+                count = OrderingContext.objects.next_count("testcase3-ordering")
+            self.assertEqual(count, expected)
+        context = OrderingContext.objects.get(context_key="testcase3-ordering")
+        self.assertEqual(context.last_count, 3)
+        self.assertIsNone(context.last_date)
+        # same count within similarity slot
+        counts = [OrderingContext.objects.next_count("testcase4-ordering", 60)
+                  for _ in range(3)]
+        self.assertTrue(counts in ([1, 1, 1], [1, 1, 2], [1, 2, 2]))
+        self.assertIsNotNone(
+            OrderingContext.objects.get(context_key="testcase4-ordering")
+            .last_date
+        )
+
+    def test_block_allocation(self):
+        allocator = OrderingBlockAllocator(block_size=10)
+        with self.assertNumQueries(1):
+            counts = [allocator.next("testcase5-ordering") for _ in range(10)]
+        self.assertEqual(counts, list(range(1, 11)))
+        other = OrderingBlockAllocator(block_size=10)
+        self.assertEqual(other.next("testcase5-ordering"), 11)
+        self.assertEqual(allocator.next("testcase5-ordering"), 21)
+        # only the unused end of the most recent block can be released
+        other.release()
+        allocator.release()
+        context = OrderingContext.objects.get(context_key="testcase5-ordering")
+        self.assertEqual(context.last_count, 21)
+        self.assertEqual(allocator.next("testcase5-ordering"), 22)
+        with self.assertRaises(ValueError):
+            OrderingDateField(block_size=10, similarity_distance=1)
+
+    def test_block_allocation_rollback(self):
+        key = "testcase6-ordering"
+        allocator = OrderingBlockAllocator(block_size=3)
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            self.assertEqual(allocator.next(key), 1)
+            raise RuntimeError
+        # the rolled back block is dropped instead of handed out again
+        other = OrderingBlockAllocator(block_size=3)
+        other_counts = [other.next(key) for _ in range(3)]
+        counts = [allocator.next(key) for _ in range(3)]
+        self.assertEqual(other_counts, [1, 2, 3])
+        self.assertEqual(counts, [4, 5, 6])
+        # blocks reserved in a committed transaction are kept
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(other.next(key), 7)
+        self.assertEqual(other.next(key), 8)
+
+    def test_block_allocation_concurrent_reservation(self):
+        key = "testcase7-ordering"
+        allocator = OrderingBlockAllocator(block_size=3)
+        reserving, done = threading.Event(), threading.Event()
+        waited = []
+
+        def wait_for_row_lock(execute, sql, params, many, context):
+            # the reservation of the other thread waits for the uncommitted
+            # row of this test's transaction
+            reserving.set()
+            waited.append(done.wait(timeout=2))
+            raise DatabaseError("could not obtain lock")
+
+        def reserve():
+            try:
+                with connection.execute_wrapper(wait_for_row_lock):
+                    allocator.next(key)
+            except DatabaseError:
+                pass
+            finally:
+                connection.close()
+
+        with transaction.atomic():
+            self.assertEqual(allocator.next(key), 1)
+            thread = threading.Thread(target=reserve)
+            thread.start()
+            self.assertTrue(reserving.wait(timeout=2))
+            # the block of this transaction is handed out without waiting
+            self.assertEqual(allocator.next(key), 2)
+            done.set()
+            thread.join()
+        self.assertEqual(waited, [True])
+
     def test_hash_context_key(self):
         key_string = "this-is-a-test"
         key1 = hash_context_key(key_string)
@@ -93,6 +295,17 @@ class OrderingContextTestCase(TestCase):
 
 class VanishingDateTimeTestCase(TestCase):
 
+    def test_unordered_queries_use_dt_index(self):
+        self.assertNotIn('ORDER BY',
+                         str(VanishingDateTime.objects.all().query))
+        with transaction.atomic(), connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # tiny test tables are otherwise scanned sequentially
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            plan = VanishingDateTime.objects.filter(
+                dt__gte=timezone.now()).explain()
+        self.assertIn('privacydates_dt_idx', plan)
+
     def test_vanishingdatetime_creation(self):
         policy1 = make_policy([
             Precision(seconds=5).after(seconds=1),
@@ -106,9 +319,9 @@ class VanishingDateTimeTestCase(TestCase):
         self.assertEqual(dta1.dt, dta2.dt)
         # policy instance should be reused
         self.assertEqual(dta1.vanishing_policy, dta2.vanishing_policy)
-        self.assertEqual(dta1.events.count(), 1)
+        self.assertIsNotNone(dta1.next_event_date)
 
-        # reduction should be applied immediately and no events created
+        # reduction should be applied immediately and no event scheduled
         policy2 = make_policy([
             Precision(seconds=5).after(seconds=0),
         ])
@@ -117,8 +330,8 @@ class VanishingDateTimeTestCase(TestCase):
         self.assertNotEqual(now, dta3.dt)
         self.assertEqual(dta3.dt, dta4.dt)
         self.assertEqual(dta3.vanishing_policy, dta4.vanishing_policy)
-        self.assertEqual(dta3.events.count(), 0)
-        self.assertEqual(dta4.events.count(), 0)
+        self.assertIsNone(dta3.next_event_date)
+        self.assertIsNone(dta4.next_iteration)
 
         policy3 = make_policy([
             Precision(seconds=120).after(seconds=550000),
@@ -139,7 +352,7 @@ class VanishingDateTimeTestCase(TestCase):
         self.assertEqual(dta7.dt, dta8.dt)
         self.assertEqual(dta7.vanishing_policy, dta8.vanishing_policy)
         self.assertEqual(dta7.vanishing_policy.policy, policy4.policy)
-        self.assertEqual(dta8.events.count(), 1)
+        self.assertEqual(dta8.next_iteration, 0)
 
     def test_faulty_vanishing_policies(self):
         now = timezone.now()
@@ -191,6 +404,377 @@ class VanishingDateTimeTestCase(TestCase):
         self.assertEqual(VanishingPolicy.objects.filter(ordering_key__contains=context2).count(), 0)
 
 
+    def test_single_insert_creation(self):
+        now = timezone.now()
+        policy = make_policy([
+            Precision(minutes=1),
+            Precision(hours=1).after(minutes=15),
+        ])
+        with self.assertNumQueries(1):
+            # date insert with the scheduled step
+            vandate = VanishingFactory(policy).create(now)
+        self.assertEqual(vandate.dt, Precision(minutes=1).apply(now))
+        vandate.refresh_from_db()
+        self.assertEqual(vandate.dt, Precision(minutes=1).apply(now))
+        scheduled = (vandate.next_iteration, vandate.next_event_date)
+        self.assertEqual(scheduled, (1, vandate.dt + timedelta(minutes=15)))
+        # later saves do not reduce or plan again
+        vandate.dt = now
+        vandate.save()
+        vandate.refresh_from_db()
+        self.assertEqual(vandate.dt, now)
+        self.assertEqual((vandate.next_iteration, vandate.next_event_date),
+                         scheduled)
+
+    def test_factory_bulk_create(self):
+        now = timezone.now()
+        dates = [now - timedelta(minutes=m) for m in range(5)]
+        factory = VanishingFactory([
+            Precision(minutes=1),
+            Precision(hours=1).after(minutes=15),
+        ])
+        for context in (None, "bulk"):
+            single = [factory.create(date, context=context) for date in dates]
+            with self.assertNumQueries(6 if context else 3):
+                # (policy lookup,) savepoint, (context select and update,)
+                # insert and release
+                bulk = factory.bulk_create(dates, context=context)
+            for created in bulk:
+                created.refresh_from_db()
+            if context is None:
+                self.assertEqual([v.dt for v in bulk], [v.dt for v in single])
+            else:
+                # ordering counts continue in list order
+                self.assertEqual([v.dt.microsecond for v in bulk],
+                                 list(range(len(dates), 2 * len(dates))))
+                self.assertEqual([v.dt.replace(microsecond=0) for v in bulk],
+                                 [v.dt.replace(microsecond=0) for v in single])
+            self.assertEqual(
+                [(v.next_iteration, v.next_event_date) for v in bulk],
+                [(v.next_iteration, v.next_event_date) for v in single],
+            )
+
+
+class VanishingExecutionTestCase(TestCase):
+    policy_steps = [
+        Precision(seconds=5),
+        Precision(minutes=1).after(minutes=1),
+        Precision(hours=1).after(minutes=30),
+        Precision(days=1).after(days=2),
+    ]
+
+    def create_dates(self, context=None):
+        now = timezone.now()
+        factory = VanishingFactory(self.policy_steps)
+        offsets = [timedelta(seconds=10), timedelta(minutes=2),
+                   timedelta(hours=1), timedelta(days=3)]
+        return [factory.create(now - offset, context=context)
+                for offset in offsets for _ in range(3)]
+
+    def create_broken_date(self):
+        # a due date of a deleted policy fails every run
+        policy = make_policy([Precision(minutes=1).after(minutes=1)])
+        vandate = VanishingFactory(policy).create(
+            timezone.now() - timedelta(hours=1))
+        VanishingPolicy.objects.filter(pk=policy.pk).delete()
+        VanishingPolicy.objects.clear_cached()
+        return vandate
+
+    def snapshot(self, dates):
+        result = []
+        for date in dates:
+            date.refresh_from_db()
+            result.append((date.dt, date.next_iteration,
+                           date.next_event_date))
+        return result
+
+    def test_batch_matches_single(self):
+        dates = self.create_dates() + self.create_dates("batch-context")
+        with transaction.atomic():
+            update_vanishing()
+            single_result = self.snapshot(dates)
+            transaction.set_rollback(True)
+        update_vanishing(batch_size=4)
+        self.assertEqual(self.snapshot(dates), single_result)
+
+    def test_batch_query_count(self):
+        self.create_dates()
+        # the oldest dates are due for all three delayed steps, but are caught
+        # up in one round of claim (write lock on SQLite) and select, policy
+        # fetch and a single update plus a final claim.
+        # Savepoints are added by the atomic blocks.
+        with self.assertNumQueries(4 + 2 + 2 + 2):
+            stats = update_vanishing(batch_size=100)
+        self.assertEqual((stats.events, stats.batches, stats.queries),
+                         (9, 1, 10))
+
+    def test_run_stats(self):
+        self.create_dates()
+        runs = []
+
+        def receiver(sender, stats, **kwargs):
+            runs.append(stats)
+
+        vanishing_run_finished.connect(receiver)
+        try:
+            backlog = VanishingDateTime.objects.backlog()
+            self.assertEqual(backlog.pending, 9)
+            # the oldest date is due for the daily step since a day
+            self.assertGreater(backlog.oldest_age, timedelta(days=1))
+            stats = update_vanishing()
+        finally:
+            vanishing_run_finished.disconnect(receiver)
+        self.assertEqual(runs, [stats])
+        self.assertEqual((stats.events, stats.skipped, stats.batches),
+                         (9, 0, 9))
+        self.assertEqual(stats.lag.count, 9)
+        # the lag bucket above a day holds the three oldest dates
+        self.assertEqual(stats.lag.counts[-1], 3)
+        self.assertEqual(VanishingDateTime.objects.backlog(), (0, None))
+        text = stats.to_prometheus(VanishingDateTime.objects.backlog())
+        self.assertIn("privacydates_vanishing_events_total 9\n", text)
+        self.assertIn('privacydates_vanishing_lag_seconds_bucket{le="+Inf"} 9\n',
+                      text)
+        self.assertIn("privacydates_vanishing_backlog_events 0\n", text)
+        out = StringIO()
+        call_command('vanishdates', stats='-', stdout=out)
+        self.assertIn("privacydates_vanishing_events_total 0\n",
+                      out.getvalue())
+
+    def test_catch_up_matches_replay(self):
+        dates = self.create_dates() + self.create_dates("catch-up-context")
+        now = timezone.now()
+        with transaction.atomic():
+            # replay overdue dates step by step
+            due = VanishingDateTime.objects.due(now)
+            while due.exists():
+                for vandate in due.all():
+                    execute_event(vandate)
+            replay_result = self.snapshot(dates)
+            transaction.set_rollback(True)
+        for vandate in VanishingDateTime.objects.due(now):
+            execute_event(vandate, now=now)
+        # a single pass leaves no due events behind
+        self.assertFalse(
+            VanishingDateTime.objects.due(now).exists())
+        self.assertEqual(self.snapshot(dates), replay_result)
+
+    def test_execute_claimed_once(self):
+        self.create_dates()
+        stale = list(VanishingDateTime.objects.due())
+        expected = self.snapshot(list(VanishingDateTime.objects.due()))
+        update_vanishing(batch_size=5)
+        # fresh instances, the stale ones keep their executed schedule
+        executed = self.snapshot([VanishingDateTime(pk=vandate.pk)
+                                  for vandate in stale])
+        self.assertNotEqual(executed, expected)
+        # steps executed by another run are skipped instead of reapplied
+        for vandate in stale:
+            self.assertFalse(execute_event(vandate))
+        self.assertEqual(self.snapshot(stale), executed)
+        with self.assertRaises(CommandError):
+            call_command('vanishdates', workers=2, daemon=True)
+
+    async def test_aupdate_vanishing(self):
+        dates = await sync_to_async(self.create_dates)()
+
+        @sync_to_async
+        def sync_snapshot():
+            with transaction.atomic():
+                update_vanishing()
+                result = self.snapshot(dates)
+                transaction.set_rollback(True)
+            return result
+
+        sync_result = await sync_snapshot()
+        await aupdate_vanishing(batch_size=4)
+        self.assertEqual(await sync_to_async(self.snapshot)(dates),
+                         sync_result)
+
+    async def test_lifespan_scheduler(self):
+        await sync_to_async(self.create_dates)()
+        messages = asyncio.Queue()
+        sent = []
+
+        async def send(message):
+            sent.append(message['type'])
+
+        async def app(scope, receive, send):
+            sent.append(scope['type'])
+
+        application = VanishingLifespanMiddleware(app, max_interval=0.05)
+        await application({'type': 'http'}, messages.get, send)
+        lifespan = asyncio.ensure_future(
+            application({'type': 'lifespan'}, messages.get, send))
+        await messages.put({'type': 'lifespan.startup'})
+        await asyncio.sleep(0.3)
+        await messages.put({'type': 'lifespan.shutdown'})
+        await lifespan
+        self.assertEqual(sent, ['http', 'lifespan.startup.complete',
+                                'lifespan.shutdown.complete'])
+        self.assertFalse(
+            await sync_to_async(VanishingDateTime.objects.due().exists)())
+
+    async def test_lifespan_scheduler_survives_errors(self):
+        vandate = await sync_to_async(self.create_broken_date)()
+        messages = asyncio.Queue()
+        sent = []
+
+        async def send(message):
+            sent.append(message['type'])
+
+        application = VanishingLifespanMiddleware(None, max_interval=0.05)
+        with self.assertLogs('privacydates.asgi', 'ERROR') as logs:
+            lifespan = asyncio.ensure_future(
+                application({'type': 'lifespan'}, messages.get, send))
+            await messages.put({'type': 'lifespan.startup'})
+            await asyncio.sleep(0.3)
+            await messages.put({'type': 'lifespan.shutdown'})
+            await lifespan
+        # the scheduler kept running after the first failure
+        self.assertGreater(len(logs.records), 1)
+        self.assertEqual(sent, ['lifespan.startup.complete',
+                                'lifespan.shutdown.complete'])
+        await sync_to_async(VanishingDateTime.objects.filter(
+            pk=vandate.pk).delete)()
+
+    def test_vanishdates_plan(self):
+        self.create_dates()
+        before = list(VanishingDateTime.objects.values_list(
+            'pk', 'dt', 'next_iteration', 'next_event_date'))
+        out = StringIO()
+        with self.assertNumQueries(2):
+            # backlog and schedule
+            call_command('vanishdates', plan=True, horizon='3d',
+                         bucket='day', stdout=out)
+        output = out.getvalue()
+        self.assertIn("Overdue events: 9 ", output)
+        # the three newest dates are scheduled for the minute step
+        self.assertIn("step 1: 3\n", output)
+        self.assertIn("Total scheduled: 3\n", output)
+        self.assertEqual(before, list(VanishingDateTime.objects.values_list(
+            'pk', 'dt', 'next_iteration', 'next_event_date')))
+        with self.assertRaises(CommandError):
+            call_command('vanishdates', plan=True, horizon='tomorrow')
+
+    def test_vanishdates_daemon(self):
+        self.create_dates()
+        self.assertTrue(VanishingDateTime.objects.due().exists())
+        command = vanishdates.Command(stdout=StringIO(), stderr=StringIO())
+        timer = threading.Timer(0.5, command.stop.set)
+        timer.start()
+        call_command(command, daemon=True, max_interval=0.05)
+        timer.join()
+        self.assertFalse(VanishingDateTime.objects.due().exists())
+        self.assertIn("stopped", command.stdout.getvalue())
+
+    def test_vanishdates_daemon_survives_errors(self):
+        vandate = self.create_broken_date()
+        command = vanishdates.Command(stdout=StringIO(), stderr=StringIO())
+        timer = threading.Timer(0.3, command.stop.set)
+        timer.start()
+        call_command(command, daemon=True, max_interval=0.05)
+        timer.join()
+        # the daemon kept running after the first failure
+        self.assertGreater(
+            command.stderr.getvalue().count("Vanishing failed"), 1)
+        self.assertIn("stopped", command.stdout.getvalue())
+        vandate.delete()
+
+    def test_seconds_until_next_run(self):
+        now = timezone.now()
+        self.assertEqual(seconds_until_next_run(None, 0, 60), 60)
+        self.assertAlmostEqual(
+            seconds_until_next_run(now + timedelta(seconds=30), 0, 60), 30,
+            delta=1)
+        self.assertEqual(
+            seconds_until_next_run(now + timedelta(hours=1), 0, 60), 60)
+        # due events left after executing some are claimed again at once
+        self.assertEqual(seconds_until_next_run(now, 5, 60), 0)
+        # due events held by another executor are not polled in a loop
+        self.assertEqual(seconds_until_next_run(now, 0, 60),
+                         BUSY_RETRY_INTERVAL)
+        self.assertEqual(seconds_until_next_run(now, 0, 0.5), 0.5)
+
+
+class VanishingPolicyCacheTestCase(TestCase):
+
+    def tearDown(self):
+        VanishingPolicy.objects.clear_cached()
+        clear_policy_registry()
+
+    def test_policy_cache(self):
+        policy = make_policy([Precision(minutes=1)])
+        # policies are cached once committed
+        with self.captureOnCommitCallbacks(execute=True):
+            VanishingPolicy.objects.get_cached(policy.pk)
+        with self.assertNumQueries(0):
+            cached = VanishingPolicy.objects.get_cached(policy.pk)
+        self.assertEqual(repr(cached.policy), repr(policy.policy))
+        vandate = VanishingDateTime(dt=timezone.now(),
+                                    vanishing_policy_id=policy.pk)
+        with self.assertNumQueries(0):
+            self.assertIs(vandate.cached_policy, cached)
+        # saved policies are immutable, so cached entries cannot go stale
+        policy.ordering_key = "changed"
+        with self.assertRaises(ValueError):
+            policy.save()
+        self.assertFalse(
+            admin.site._registry[VanishingPolicy].has_change_permission(None))
+        with self.assertNumQueries(0):
+            fetched = VanishingPolicy.objects.get_cached(policy.pk)
+        self.assertIsNone(fetched.ordering_key)
+        # uncommitted policies are not cached
+        uncommitted = make_policy([Precision(minutes=5)])
+        for _ in range(2):
+            with self.assertNumQueries(1):
+                VanishingPolicy.objects.get_cached(uncommitted.pk)
+        with self.assertRaises(VanishingPolicy.DoesNotExist):
+            VanishingPolicy.objects.get_cached(uncommitted.pk + 1)
+
+
+    def test_make_policy_memo(self):
+        steps = [
+            Precision(minutes=1),
+            Precision(hours=1).after(minutes=15),
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            policy = make_policy(steps, "memo")
+        # equal steps hit the memo without validation or lookup
+        same_steps = [
+            Precision(seconds=60),
+            Precision(minutes=60).after(seconds=900),
+        ]
+        factory = VanishingFactory(same_steps, context="memo")
+        with self.assertNumQueries(0):
+            self.assertEqual(make_policy(same_steps, "memo"), policy)
+            self.assertEqual(factory.policy.pk, policy.pk)
+        self.assertNotEqual(make_policy(steps).pk, policy.pk)
+        # deletion invalidates the memo
+        policy.delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            recreated = make_policy(steps, "memo")
+        self.assertNotEqual(recreated.pk, policy.pk)
+
+
+class VanishingScheduleQueryTestCase(TestCase):
+
+    def test_due_uses_next_event_index(self):
+        now = timezone.now()
+        with transaction.atomic(), connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # tiny test tables are otherwise scanned sequentially
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            plan = VanishingDateTime.objects.due(now).explain()
+        self.assertIn('privacydates_next_event_idx', plan)
+        # due events come oldest first
+        factory = VanishingFactory([Precision(minutes=1).after(minutes=1)])
+        for offset in (5, 60, 20):
+            factory.create(now - timedelta(minutes=offset))
+        dates = list(VanishingDateTime.objects.due(now)
+                     .values_list('next_event_date', flat=True))
+        self.assertEqual(len(dates), 3)
+        self.assertEqual(dates, sorted(dates))
 
 
 class VanishingOrderingContextTestCase(TestCase):
@@ -1,79 +1,328 @@
 """Uitilites for VanishingDateField"""
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import List, Optional, overload
-
-from django.db import transaction
+from functools import partial
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple, overload
+
+from asgiref.sync import sync_to_async
+from django.db import connections, router, transaction
+from django.db.models import F, QuerySet
 from django.utils import timezone
 
-from .models import VanishingEvent, VanishingDateTime, VanishingPolicy
+from .models import (
+    POLICY_CACHE_SIZE,
+    VanishingDateTime,
+    VanishingOrderingContext,
+    VanishingPolicy,
+)
 from .order import hash_context_key
 from .precision import Precision
+from .stats import VanishingRunStats, vanishing_run_finished
 
 
 __all__ = [
-    'VanishingFactory', 'update_vanishing',
+    'VanishingFactory', 'aupdate_vanishing', 'update_vanishing',
 ]
 
 
 PolicySteps = List[Precision]
+PolicyKey = Tuple[Tuple[Tuple[int, int, int, int], ...], Optional[str]]
 
+# maps normalized policy steps and ordering key to the pk of their policy
+_policy_registry: 'OrderedDict[PolicyKey, int]' = OrderedDict()
+_policy_registry_lock = threading.Lock()
 
-def event_creator(instance: VanishingDateTime, iteration: int) -> None:
-    """Create a vanishing event for a given instance of VanishingDateTime
+# seconds executors wait before claiming again, when the due events are
+# held by another executor
+BUSY_RETRY_INTERVAL = 1.0
 
-    Parameters
-    ----------
-    instance : VanishingDateTime
-        The VanishingDateTime for which the event should be created
-    iteration : int
-        The iteration step in the VanishingPolicy
+
+def schedule_step(instance: VanishingDateTime, iteration: int) -> None:
+    """Schedule the given policy step of instance (without saving).
+    If the policy has no such step, the schedule is cleared.
     """
-    next_precision: Precision = instance.vanishing_policy.policy[iteration]
+    policy = instance.cached_policy.policy
+    if iteration >= len(policy):
+        instance.next_event_date = None
+        instance.next_iteration = None
+        return
+    next_precision: Precision = policy[iteration]
     assert next_precision.apply_after_seconds is not None
-    event_date = instance.dt + next_precision.apply_after_timedelta
-    VanishingEvent.objects.create(
-        vanishing_datetime=instance,
-        event_date=event_date,
-        iteration=iteration,
-    )
+    instance.next_event_date = \
+        instance.dt + next_precision.apply_after_timedelta
+    instance.next_iteration = iteration
 
 
-def update_vanishing():
+def apply_initial_step(instance: VanishingDateTime) -> None:
+    """Apply the first policy step to instance if it applies immediately
+    and schedule the next step (without saving).
+    """
+    first_precision: Precision = instance.cached_policy.policy[0]
+    if first_precision.is_applied_immediately():
+        instance.dt = first_precision.apply(instance.dt)
+        schedule_step(instance, 1)
+    else:
+        schedule_step(instance, 0)
+
+
+def update_vanishing(batch_size: Optional[int] = None) -> VanishingRunStats:
     """Executes all pending vanishing events.
-    This includes changing the timestamps and creating succeding
-    VanishingEvents if necessary.
+    This includes changing the timestamps and scheduling the succeeding
+    policy steps if necessary.
+
+    Parameters
+    ----------
+    batch_size : int (optional)
+        If given, dates with due events are fetched in chunks of this size
+        with a scan of the next_event_date index and executed set-based with
+        a single bulk update per chunk.
+        Otherwise events are executed one by one.
+
+    Returns
+    -------
+    VanishingRunStats
+        Statistics of the run, which are also sent with the
+        vanishing_run_finished signal
+
+    Several executors may run concurrently, dates are claimed with row locks
+    so each one is executed once (see claim_events).
     """
     now = timezone.now()
-    events_pending = True
-    while events_pending:
-        events_pending = False
-        for event in VanishingEvent.objects.filter(event_date__lte=now):
-            # Set events_pending to true,
-            # as a newly created vanishing event may already be in the past,
-            # and a new iteration over events is necessary.
-            events_pending = True
-            execute_event(event)
+    if batch_size is not None and batch_size <= 0:
+        raise ValueError("batch_size must be positive")
+    stats = VanishingRunStats()
+    start = time.perf_counter()
+    with stats.count_queries(router.db_for_write(VanishingDateTime)):
+        if batch_size is not None:
+            # Executed steps are rescheduled to the future, so simply claim
+            # again until no due event is left.
+            while True:
+                batch_start = time.perf_counter()
+                if not execute_due_events(batch_size, now, stats):
+                    break
+                stats.observe_batch(time.perf_counter() - batch_start)
+        else:
+            # Overdue steps are caught up on execution, so no newly created
+            # step can be due yet and a single pass suffices.
+            for vandate in VanishingDateTime.objects.due(now):
+                batch_start = time.perf_counter()
+                execute_event(vandate, now, stats)
+                stats.observe_batch(time.perf_counter() - batch_start)
+    stats.seconds = time.perf_counter() - start
+    vanishing_run_finished.send(sender=VanishingDateTime, stats=stats)
+    return stats
 
 
-@transaction.atomic()
-def execute_event(event: VanishingEvent):
-    """Execute vanishing event."""
+async def aupdate_vanishing(batch_size: int = 1000) -> VanishingRunStats:
+    """Asynchronous version of update_vanishing in batch mode, for calling
+    from async code like ASGI applications without blocking the event loop.
+
+    Django's ORM has no asynchronous transactions, so each batch is claimed
+    and executed in one transaction in the thread of the synchronous ORM
+    calls. Control returns to the event loop between batches.
+
+    Parameters
+    ----------
+    batch_size : int
+        Number of events executed per transaction
+
+    Returns
+    -------
+    VanishingRunStats
+        Statistics of the run, which are also sent with the
+        vanishing_run_finished signal
+    """
+    if batch_size <= 0:
+        raise ValueError("batch_size must be positive")
+    now = timezone.now()
+    stats = VanishingRunStats()
+    start = time.perf_counter()
+
+    @partial(sync_to_async, thread_sensitive=True)
+    def execute_batch():
+        batch_start = time.perf_counter()
+        with stats.count_queries(router.db_for_write(VanishingDateTime)):
+            executed = execute_due_events(batch_size, now, stats)
+        if executed:
+            stats.observe_batch(time.perf_counter() - batch_start)
+        return executed
+
+    while await execute_batch():
+        pass
+    stats.seconds = time.perf_counter() - start
+    await sync_to_async(vanishing_run_finished.send, thread_sensitive=True)(
+        sender=VanishingDateTime, stats=stats)
+    return stats
+
+
+def seconds_until_next_run(next_date: Optional[datetime], executed: int,
+                           max_interval: float) -> float:
+    """Seconds a periodic executor sleeps before its next run: until
+    next_date, the earliest scheduled event, but at most max_interval.
+
+    If next_date is due already although the last run executed nothing,
+    the due events are held by another executor (SKIP LOCKED). Then wait
+    BUSY_RETRY_INTERVAL instead of claiming again in a tight loop.
+    """
+    if next_date is None:
+        return max_interval
+    delay = (next_date - timezone.now()).total_seconds()
+    if delay <= 0 and not executed:
+        delay = BUSY_RETRY_INTERVAL
+    return min(max(delay, 0), max_interval)
+
+
+def claim_events(queryset: QuerySet) -> QuerySet:
+    """Lock the dates of queryset for executing their scheduled step in the
+    current transaction, so concurrent executors never execute the same step
+    twice.
+
+    Dates locked by another executor are skipped where the database supports
+    SKIP LOCKED. Databases without row locks (SQLite) only have a single
+    writer, so the write lock is acquired before reading instead. Concurrent
+    executors then wait for each other and read the committed state.
+    Must be called inside an atomic block.
+    """
+    features = connections[queryset.db].features
+    if features.has_select_for_update:
+        return queryset.select_for_update(
+            skip_locked=features.has_select_for_update_skip_locked)
+    # An update, even matching no row, starts the write transaction
+    VanishingDateTime.objects.using(queryset.db).filter(pk__isnull=True)\
+        .update(next_iteration=F('next_iteration'))
+    return queryset
+
+
+def reduce_vanishing_datetime(vandate: VanishingDateTime, iteration: int,
+                              now: Optional[datetime] = None) -> int:
+    """Apply the given policy step to the date of vandate (without saving).
+
+    If now is given, all subsequent steps which are already due at now are
+    applied as well. Thereby an overdue date reaches its final state with a
+    single write instead of replaying every step as separate event.
+
+    Returns
+    -------
+    int
+        The iteration of the next pending step
+    """
+    policy = vandate.cached_policy.policy
     # Save ordering
-    vandate = event.vanishing_datetime
-    order_count = int(vandate.dt.strftime('%f'))
-    # Generalize Datetime
-    policy = vandate.vanishing_policy.policy
-    new_precision = policy[event.iteration]
-    vandate.dt = new_precision.apply(vandate.dt)
-    # Re-add order, if ordering functionality was used.
-    if vandate.vanishing_policy.ordering_key:
-        vandate.dt += timedelta(microseconds=order_count)
-    vandate.save()
-    # Create next event, if more step are planned
-    next_iteration = event.iteration + 1
-    if next_iteration < len(event.vanishing_datetime.vanishing_policy.policy):
-        event_creator(vandate, iteration=next_iteration)
-    event.delete()  ## Delete old event
+    order_count = vandate.dt.microsecond
+    while True:
+        # Generalize Datetime
+        vandate.dt = policy[iteration].apply(vandate.dt)
+        # Re-add order, if ordering functionality was used.
+        if vandate.cached_policy.ordering_key:
+            vandate.dt += timedelta(microseconds=order_count)
+        iteration += 1
+        if now is None or iteration >= len(policy):
+            return iteration
+        if vandate.dt + policy[iteration].apply_after_timedelta > now:
+            return iteration
+
+
+@transaction.atomic()
+def execute_event(vandate: VanishingDateTime,
+                  now: Optional[datetime] = None,
+                  stats: Optional[VanishingRunStats] = None) -> bool:
+    """Execute the scheduled step of vandate and schedule the next one.
+    If now is given, subsequent steps already due at now are executed too.
+    If stats is given, the execution is counted there.
+
+    Returns
+    -------
+    bool
+        False if the step was already executed or is being executed by
+        another executor
+    """
+    event_date = vandate.next_event_date
+    if event_date is not None:
+        vandate = claim_events(VanishingDateTime.objects.filter(
+            pk=vandate.pk, next_event_date=event_date,
+            next_iteration=vandate.next_iteration,
+        )).first()
+    if vandate is None or event_date is None:
+        if stats is not None:
+            stats.skipped += 1
+        return False
+    next_iteration = reduce_vanishing_datetime(vandate,
+                                               vandate.next_iteration, now)
+    schedule_step(vandate, next_iteration)
+    vandate.save(update_fields=['dt', 'next_event_date', 'next_iteration'])
+    if stats is not None:
+        lag = timezone.now() - event_date
+        stats.observe_events([lag.total_seconds()])
+    return True
+
+
+@transaction.atomic()
+def execute_due_events(batch_size: int,
+                       now: Optional[datetime] = None,
+                       stats: Optional[VanishingRunStats] = None) -> int:
+    """Claim up to batch_size dates with a due step and execute them with
+    execute_events. Dates claimed by concurrent executors are skipped.
+
+    Returns
+    -------
+    int
+        Number of executed steps, 0 if no unclaimed step is due
+    """
+    if now is None:
+        now = timezone.now()
+    vandates = list(
+        claim_events(VanishingDateTime.objects.due(now))[:batch_size])
+    if not vandates:
+        return 0
+    return _execute_events(vandates, now, stats)
+
+
+@transaction.atomic()
+def execute_events(vandates: List[VanishingDateTime],
+                   now: Optional[datetime] = None,
+                   stats: Optional[VanishingRunStats] = None) -> int:
+    """Execute the scheduled steps of a batch of dates with a constant number
+    of queries: the dates and their new schedule are written in place with
+    bulk_update_schedule.
+    If now is given, subsequent steps already due at now are executed too.
+
+    Dates without scheduled step are ignored. Policies are taken from the
+    policy cache.
+    If stats is given, the executed steps are counted there.
+
+    Returns
+    -------
+    int
+        Number of executed steps
+    """
+    return _execute_events(vandates, now, stats)
+
+
+def _execute_events(vandates: List[VanishingDateTime],
+                    now: Optional[datetime],
+                    stats: Optional[VanishingRunStats] = None) -> int:
+    """execute_events without its own atomic block."""
+    vandates = [vandate for vandate in vandates
+                if vandate.next_event_date is not None]
+    if not vandates:
+        return 0
+    event_dates = [vandate.next_event_date for vandate in vandates]
+    policies = VanishingPolicy.objects.get_many_cached(
+        {vandate.vanishing_policy_id for vandate in vandates})
+    for vandate in vandates:
+        vandate.vanishing_policy = policies[vandate.vanishing_policy_id]
+        next_iteration = reduce_vanishing_datetime(
+            vandate, vandate.next_iteration, now)
+        schedule_step(vandate, next_iteration)
+    VanishingDateTime.objects.bulk_update_schedule(vandates)
+    if stats is not None:
+        executed_at = timezone.now()
+        stats.observe_events(
+            (executed_at - event_date).total_seconds()
+            for event_date in event_dates)
+    return len(vandates)
 
 
 class VanishingFactory:
@@ -176,6 +425,56 @@ class VanishingFactory:
         -------
         VanishingDateTime
         """
+        policy = self._resolve_policy(policy, context, hashed)
+        vandate = VanishingDateTime(dt=date, vanishing_policy=policy)
+        vandate.save()
+        return vandate
+
+    def bulk_create(self, dates: Iterable[datetime], policy=None,
+                    context=None, hashed=False,
+                    batch_size: Optional[int] = None) -> List[VanishingDateTime]:
+        """Creates and saves VanishingDateTime objects for all given
+        datetimes with bulk queries.
+        Policy, context and hashed behave as for create.
+
+        Other than with QuerySet.bulk_create, the dates are set up like with
+        create: the immediate policy step is applied, ordering counts are
+        assigned in the given order and the next step is scheduled.
+        However, no post_save signals are sent.
+
+        Parameters
+        ----------
+        dates : iterable of datetime
+            The initial datetimes
+
+        batch_size : int (optional)
+            Maximum number of objects inserted per query
+
+        Returns
+        -------
+        list of VanishingDateTime
+        """
+        policy = self._resolve_policy(policy, context, hashed)
+        vandates = [VanishingDateTime(dt=date, vanishing_policy=policy)
+                    for date in dates]
+        # steps are scheduled from the dates without ordering counts
+        for vandate in vandates:
+            apply_initial_step(vandate)
+        with transaction.atomic():
+            if policy.ordering_key is not None:
+                context_obj, _ = VanishingOrderingContext.objects\
+                    .select_for_update()\
+                    .get_or_create(context_key=policy.ordering_key)
+                counts = context_obj.next_many(policy, len(vandates))
+                for vandate, count in zip(vandates, counts):
+                    vandate.dt = vandate.dt.replace(microsecond=count)
+            VanishingDateTime.objects.bulk_create(vandates,
+                                                  batch_size=batch_size)
+        return vandates
+
+    def _resolve_policy(self, policy, context, hashed) -> VanishingPolicy:
+        """Return the policy to use for new dates given the arguments of
+        create"""
         if not policy and not self.policy:
             raise ValueError("No policy provided")
         if hashed and context:
@@ -188,9 +487,7 @@ class VanishingFactory:
             policy = make_policy(self.policy.policy, context)
         if not policy:
             policy = self.policy
-        vandate = VanishingDateTime(dt=date, vanishing_policy=policy)
-        vandate.save()
-        return vandate
+        return policy
 
 
 def validate_policy(policy: PolicySteps):
@@ -212,11 +509,44 @@ def validate_policy(policy: PolicySteps):
         prev = step
 
 
+def policy_key(policy: PolicySteps,
+               ordering_key: Optional[str] = None) -> PolicyKey:
+    """Return a hashable key identifying the given steps and ordering key
+    the same way as they are compared when stored as VanishingPolicy."""
+    steps = tuple(
+        (step.seconds, step.months, step.years, step.apply_after_seconds or 0)
+        for step in policy
+    )
+    return steps, ordering_key
+
+
+def _register_policy(key: PolicyKey, pk: int) -> None:
+    with _policy_registry_lock:
+        _policy_registry[key] = pk
+        _policy_registry.move_to_end(key)
+        while len(_policy_registry) > POLICY_CACHE_SIZE:
+            _policy_registry.popitem(last=False)
+
+
+def clear_policy_registry(pk: Optional[int] = None) -> None:
+    """Forget the memoized steps of the policy with the given pk or of all
+    policies"""
+    with _policy_registry_lock:
+        if pk is None:
+            _policy_registry.clear()
+            return
+        for key in [k for k, v in _policy_registry.items() if v == pk]:
+            del _policy_registry[key]
+
+
 def make_policy(policy: PolicySteps,
                 ordering_key: Optional[str] = None) -> VanishingPolicy:
     """Creates or gets (when already existing) a VanishingPolicy
      with the given dict and return the created object
 
+    Policies are memoized per process, so that repeated calls with the same
+    steps and ordering key skip validation and the lookup by policy.
+
     Parameters
     ----------
     policy : List[Precision]
@@ -232,9 +562,20 @@ def make_policy(policy: PolicySteps,
     VanishingPolicy
         The created Policy
     """
+    key = policy_key(policy, ordering_key)
+    with _policy_registry_lock:
+        pk = _policy_registry.get(key)
+    if pk is not None:
+        try:
+            return VanishingPolicy.objects.get_cached(pk)
+        except VanishingPolicy.DoesNotExist:
+            clear_policy_registry(pk)
     validate_policy(policy)
     vanpol, _created = VanishingPolicy.objects.get_or_create(
         policy=policy,
         ordering_key=ordering_key,
     )
+    # only remember committed policies
+    transaction.on_commit(partial(_register_policy, key, vanpol.pk))
+    VanishingPolicy.objects.add_cached([vanpol])
     return vanpol
@@ -13,4 +13,10 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dateTester.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# privacydates needs the app registry, so import after Django is set up
+from privacydates.asgi import VanishingLifespanMiddleware  # noqa: E402
+
+# executes due vanishing events in the background while the server runs
+application = VanishingLifespanMiddleware(django_application)
@@ -2,9 +2,14 @@ from django.db import models
 from django.utils import timezone
 
 from privacydates import fields
+from privacydates.managers import OrderingDateQuerySet, VanishingDateQuerySet
 from privacydates.mixins import VanishingDateMixIn
 
 
+class EventQuerySet(OrderingDateQuerySet, VanishingDateQuerySet):
+    pass
+
+
 class Event(models.Model, VanishingDateMixIn):
     """Basic Event with multiple timestamps representing the same time with the
     different types of privacydates date fields."""
@@ -20,5 +25,9 @@ class Event(models.Model, VanishingDateMixIn):
     ordering_similarity_date = fields.OrderingDateField(
         null=True, blank=True, hashed=False, similarity_distance=2)
 
+    objects = EventQuerySet.as_manager()
+
 class VDEvent(models.Model, VanishingDateMixIn):
     date = fields.VanishingDateField()
+
+    objects = VanishingDateQuerySet.as_manager()
@@ -22,9 +22,10 @@ class EventListView(ListView):
         return ctx
 
     def get_queryset(self):
+        events = Event.objects.with_vanishing_dates()
         if 'order' in self.request.GET:
-            return Event.objects.order_by('-' + str(self.request.GET['order']))
-        return Event.objects.order_by('-base_date')
+            return events.order_by('-' + str(self.request.GET['order']))
+        return events.order_by('-base_date')
 
 
 def event_create_view(request):
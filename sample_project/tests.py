@@ -1,3 +1,12 @@
+import copy
+import gc
+import pickle
+import weakref
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import CommandError, call_command
+from django.db import connection
 from django.test import TestCase
 from datumlista.models import Event, VDEvent
 from django.utils import timezone
@@ -9,6 +18,7 @@ from privacydates.models import (
     OrderingContext,
     VanishingDateTime,
 )
+from privacydates.management.commands.roughendates import roughen_field
 from privacydates.precision import Precision
 
 
@@ -48,6 +58,67 @@ class EventTest(TestCase):
         e.refresh_from_db()
         self.assertNotEqual(e.rough_date, now)
 
+    def test_roughendates_command(self):
+        # minutes before the rough dates of the new events
+        now = timezone.now().replace(second=42, microsecond=123) \
+            - timedelta(minutes=5)
+        events = [self.get_event() for _ in range(5)]
+        for e in events:
+            e.save()
+        # store precise dates as with an earlier, finer precision
+        Event.objects.filter(pk__in=[e.pk for e in events[:3]])\
+            .update(rough_date=now)
+        out = StringIO()
+        call_command('roughendates', 'datumlista.Event', batch_size=2,
+                     stdout=out)
+        self.assertIn("datumlista.Event.rough_date: 3 rows updated",
+                      out.getvalue())
+        rough_now = now.replace(second=30, microsecond=0)
+        self.assertEqual(
+            Event.objects.filter(rough_date=rough_now).count(), 3)
+        self.assertFalse(Event.objects.filter(rough_date=now).exists())
+
+    def test_roughendates_concurrent_save(self):
+        now = timezone.now().replace(second=42, microsecond=123) \
+            - timedelta(minutes=5)
+        later = now + timedelta(minutes=2)
+        e = self.get_event()
+        e.save()
+        Event.objects.filter(pk=e.pk).update(rough_date=now)
+        saved = []
+
+        def save_before_update(execute, sql, params, many, context):
+            # the application saves the row between the read and the write
+            if sql.startswith('UPDATE') and not saved:
+                saved.append(True)
+                Event.objects.filter(pk=e.pk).update(rough_date=later)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(save_before_update):
+            call_command('roughendates', 'datumlista.Event',
+                         stdout=StringIO())
+        e.refresh_from_db()
+        # the saved value is reduced instead of overwritten
+        self.assertEqual(e.rough_date, later.replace(second=30, microsecond=0))
+
+    def test_roughendates_local_time(self):
+        field = copy.copy(Event._meta.get_field('rough_date'))
+        field.precision = Precision(days=1)
+        # reduced by the field in the current time zone (Europe/Berlin)
+        local_midnight = timezone.localtime().replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        utc_noon = timezone.now().replace(
+            hour=12, minute=0, second=0, microsecond=0)
+        events = [self.get_event() for _ in range(2)]
+        for e, rough_date in zip(events, [local_midnight, utc_noon]):
+            e.save()
+            Event.objects.filter(pk=e.pk).update(rough_date=rough_date)
+        self.assertEqual(roughen_field(Event, field, batch_size=10), 1)
+        for e in events:
+            e.refresh_from_db()
+        self.assertEqual(events[0].rough_date, local_midnight)
+        self.assertEqual(events[1].rough_date, utc_noon.replace(hour=0))
+
     def test_orderingdate(self):
         e = self.get_event()
         e.save()
@@ -64,6 +135,126 @@ class EventTest(TestCase):
             1
         )
 
+    def test_orderingdate_bulk_create(self):
+        events = [self.get_event() for _ in range(5)]
+        events[2].ordering_date = "userB" + "en"
+        # one counter update per context and field, then the insert
+        with self.assertNumQueries(3 + 1):
+            Event.objects.bulk_create(events)
+        self.assertEqual([e.ordering_date for e in events], [1, 2, 1, 3, 4])
+        self.assertEqual(len(set(e.ordering_similarity_date for e in events)), 1)
+        e = self.get_event()
+        e.save()
+        e.refresh_from_db()
+        self.assertEqual(e.ordering_date, 5)
+
+    def test_delete_vanishing_dates(self):
+        events = [self.get_event() for _ in range(6)]
+        for e in events:
+            e.save()
+        self.assertEqual(VanishingDateTime.objects.count(), 12)
+        # single objects delete their dates by the stored ids
+        with self.assertNumQueries(2):
+            # parent delete, then the dates of both fields
+            events[0].delete()
+        self.assertEqual(VanishingDateTime.objects.count(), 10)
+        # querysets delete all dates together, independent of their size
+        with self.assertNumQueries(5):
+            # savepoint, parent select and delete, dates, release
+            Event.objects.all().delete()
+        self.assertFalse(VanishingDateTime.objects.exists())
+
+    def test_delete_shared_vanishing_date(self):
+        date = VanishingFactory(policy=self.policy1).create(timezone.now())
+        events = [VDEvent.objects.create(date=date) for _ in range(3)]
+        # the date is kept as long as another object references it
+        events[0].delete()
+        VDEvent.objects.filter(pk=events[1].pk).delete()
+        self.assertTrue(VanishingDateTime.objects.filter(pk=date.pk).exists())
+        events[2].delete()
+        self.assertFalse(VanishingDateTime.objects.exists())
+
+    def test_purgevanishingdates_command(self):
+        factory = VanishingFactory(policy=self.policy1)
+        events = [VDEvent.objects.create(date=factory.create(timezone.now()))
+                  for _ in range(5)]
+        self.get_event().save()
+        VanishingDateTime.objects.update(
+            created=timezone.now() - timedelta(hours=2))
+        # created just now for an old event, but not assigned yet
+        in_flight = factory.create(timezone.now() - timedelta(days=3))
+        # raw deletes bypass the signals and leave orphans behind
+        VDEvent.objects.filter(pk__in=[e.pk for e in events[:3]])\
+            ._raw_delete(VDEvent.objects.db)
+        out = StringIO()
+        call_command('purgevanishingdates', dry_run=True, older_than='1h',
+                     stdout=out)
+        self.assertIn("3 orphaned vanishing dates found", out.getvalue())
+        self.assertEqual(VanishingDateTime.objects.count(), 8)
+        referenced = []
+
+        def reference_before_delete(execute, sql, params, many, context):
+            # an orphan is assigned between the selection and the delete
+            if sql.startswith('DELETE') and not referenced:
+                referenced.append(
+                    VDEvent.objects.create(date_id=events[0].date_id))
+            return execute(sql, params, many, context)
+
+        out = StringIO()
+        with connection.execute_wrapper(reference_before_delete):
+            call_command('purgevanishingdates', batch_size=2,
+                         older_than='1h', stdout=out)
+        self.assertIn("2 orphaned vanishing dates deleted", out.getvalue())
+        self.assertEqual(
+            set(VanishingDateTime.objects.values_list('pk', flat=True)),
+            set(VDEvent.objects.values_list('date_id', flat=True))
+            | set(Event.objects.values_list('vanishing_date_id', flat=True))
+            | set(Event.objects.values_list(
+                'vanishing_ordering_date_id', flat=True))
+            | {in_flight.pk},
+        )
+        with self.assertRaises(CommandError):
+            call_command('purgevanishingdates', older_than='soon')
+
+    def test_vanishing_dates_loading(self):
+        for _ in range(5):
+            self.get_event().save()
+        expected = [(e.vanishing_date.dt, e.vanishing_ordering_date.dt)
+                    for e in Event.objects.order_by('pk')]
+        with self.assertNumQueries(1):
+            events = Event.objects.with_vanishing_dates().order_by('pk')
+            self.assertEqual(
+                [(e.vanishing_date.dt, e.vanishing_ordering_date.dt)
+                 for e in events], expected)
+        # without join, each field is loaded for all objects at once
+        with self.assertNumQueries(1 + 2):
+            events = Event.objects.order_by('pk')
+            self.assertEqual(
+                [(e.vanishing_date.dt, e.vanishing_ordering_date.dt)
+                 for e in events], expected)
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.client.get('/').status_code, 200)
+
+    def test_vanishing_peers_not_retained(self):
+        for _ in range(50):
+            self.get_event().save()
+        first = Event.objects.order_by('pk').first()
+        single = pickle.dumps(first)
+        expected = first.vanishing_date.dt
+        events = list(Event.objects.order_by('pk'))
+        # peers are neither pickled nor kept alive by one object
+        self.assertLess(len(pickle.dumps(events[0])), 2 * len(single))
+        restored = pickle.loads(pickle.dumps(events[0]))
+        with self.assertNumQueries(1):
+            self.assertEqual(restored.vanishing_date.dt, expected)
+        first, other = events[0], weakref.ref(events[1])
+        del events
+        gc.collect()
+        self.assertIsNone(other())
+        with self.assertNumQueries(1):
+            first.vanishing_date
+
     def test_vdtorder_insertion_preserved(self):
         """Evaluate whether the chronological order of VanishingDates is
         maintained by databases through the insertion order despite all